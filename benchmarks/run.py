@@ -0,0 +1,265 @@
+"""Нагрузочный бенчмарк всех маршрутов main.py через ASGI-клиент в том же процессе.
+
+    python -m benchmarks.run --users 100000 --couples 40000 --wishes 1000000 --reset
+    DB_BACKEND=sqlite DB_SQLITE_PATH=:memory: python -m benchmarks.run   # без сервера БД
+
+Перед прогоном база заполняется заново (см. benchmarks/seed.py), поэтому прогоны с одинаковыми
+параметрами и seed сравнимы между коммитами. Результат — JSON с пропускной способностью
+и p50/p95/p99 по каждому маршруту.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import httpx
+
+# Бенчмарк выступает ботом: ASGI-клиент приходит с 127.0.0.1, и X-Telegram-User-Id от него принимается
+os.environ.setdefault("TRUSTED_PROXIES", '["127.0.0.1"]')
+# И администратором для маршрутов /internal/*
+os.environ.setdefault("INTERNAL_TOKEN", "bench")
+
+# Новые сущности создаются с id из отдельных диапазонов, чтобы не пересекаться с посевом
+NEW_USERS = 10_000_000
+BULK_USERS = 20_000_000
+# Импорт задаёт id пар явно, и в Postgres последовательность пар уходит за них:
+# поэтому сценарий импорта идёт после удалений, которые рассчитывают на id подряд
+IMPORTED = 30_000_000
+IMPORT_COUPLES = 100
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    # (номер запроса, генератор случайных чисел) -> (путь, тело)
+    # Тело bytes отправляется как есть, остальное — как JSON
+    build: Callable
+    requests: int | None = None
+    concurrency: int | None = None
+    headers: dict | None = None
+
+
+def _wish(rng, user_id: int) -> dict:
+    return {
+        "name": f"bench wish {rng.randint(1, 10**6)}",
+        "price": round(rng.uniform(1, 1000), 2),
+        "article": rng.randint(1, 10**6),
+        "url": "https://example.com/bench",
+        "user_added_id": user_id,
+    }
+
+
+def _import_file(i: int, rng) -> bytes:
+    """NDJSON для /internal/import: IMPORT_COUPLES пар по два участника и по пять желаний у каждого"""
+    lines = []
+    for j in range(IMPORT_COUPLES):
+        couple_id = IMPORTED + i * IMPORT_COUPLES + j
+        lines.append({"type": "couple", "id": couple_id})
+        for user_id in (couple_id * 2, couple_id * 2 + 1):
+            lines.append({"type": "user", "id": user_id, "username": f"imported{user_id}", "couple_id": couple_id})
+            lines.extend({"type": "wish", **_wish(rng, user_id), "couple_id": couple_id} for _ in range(5))
+    return b"\n".join(json.dumps(line).encode() for line in lines)
+
+
+def _update(i: int, user_id: int) -> dict:
+    return {
+        "update_id": i,
+        "message": {"message_id": i, "chat": {"id": user_id}, "from": {"id": user_id, "first_name": "bench"}, "text": "/start"},
+    }
+
+
+def scenarios(args) -> list[Scenario]:
+    from database.config import settings
+
+    couple = lambda rng: rng.randint(1, args.couples)
+    user = lambda rng: rng.randint(1, args.users)
+    wish = lambda rng: rng.randint(1, args.wishes)
+    # Порядок важен: удаления идут после создания тех же сущностей
+    webhook_headers = {"X-Telegram-Bot-Api-Secret-Token": settings.TELEGRAM_WEBHOOK_SECRET or ""}
+    return [
+        # Посеянные пользователи: /start отвечает, что пользователь уже есть, и ничего не пишет
+        Scenario("POST /telegram/webhook", "POST", lambda i, rng: ("/telegram/webhook", _update(i, user(rng))), headers=webhook_headers),
+        Scenario("GET /users/", "GET", lambda i, rng: (f"/users/?limit=100&after={user(rng) - 1}", None)),
+        Scenario("GET /users/{user_id}/", "GET", lambda i, rng: (f"/users/{user(rng)}/", None)),
+        Scenario("GET /couples/", "GET", lambda i, rng: (f"/couples/?limit=100&after={couple(rng) - 1}", None)),
+        Scenario("GET /couples/{couple_id}", "GET", lambda i, rng: (f"/couples/{couple(rng)}", None)),
+        Scenario("GET /couples/{couple_id}/wishes", "GET", lambda i, rng: (f"/couples/{couple(rng)}/wishes", None)),
+        Scenario("GET /couples/{couple_id}/wishes/search", "GET", lambda i, rng: (f"/couples/{couple(rng)}/wishes/search?q=wish", None)),
+        Scenario("GET /internal/wishes/search", "GET", lambda i, rng: (f"/internal/wishes/search?q=wish+{wish(rng)}", None)),
+        Scenario("GET /couples/{couple_id}/summary", "GET", lambda i, rng: (f"/couples/{couple(rng)}/summary", None)),
+        Scenario("GET /wishes/{wish_id}", "GET", lambda i, rng: (f"/wishes/{wish(rng)}", None)),
+        Scenario("POST /users/", "POST", lambda i, rng: ("/users/", {"id": NEW_USERS + i, "username": f"new{i}"})),
+        Scenario("POST /users/bulk", "POST", lambda i, rng: (
+            "/users/bulk", [{"id": BULK_USERS + i * 100 + j, "username": f"bulk{i}_{j}"} for j in range(100)]
+        )),
+        Scenario("PUT /users/{user_id}", "PUT", lambda i, rng: (f"/users/{user(rng)}", {"username": f"renamed{i}"})),
+        Scenario("DELETE /users/{user_id}", "DELETE", lambda i, rng: (f"/users/{NEW_USERS + i}", None)),
+        Scenario("POST /couples/", "POST", lambda i, rng: (
+            "/couples/", {"user1_id": BULK_USERS + i * 100, "user2_id": BULK_USERS + i * 100 + 1}
+        )),
+        Scenario("PUT /couples/{couple_id}", "PUT", lambda i, rng: (
+            (lambda c: (f"/couples/{c}", {"user1_id": c * 2 - 1, "user2_id": c * 2}))(couple(rng))
+        )),
+        Scenario("POST /couples/{couple_id}/wishes", "POST", lambda i, rng: (
+            (lambda c: (f"/couples/{c}/wishes", [_wish(rng, c * 2) for _ in range(10)]))(couple(rng))
+        )),
+        Scenario("POST /wishes/", "POST", lambda i, rng: (
+            "/wishes/", (lambda c: {**_wish(rng, c * 2), "couple_id": c})(couple(rng))
+        )),
+        Scenario("PUT /wishes/{wish_id}", "PUT", lambda i, rng: (f"/wishes/{wish(rng)}", {"price": rng.randint(1, 1000)})),
+        # Созданные выше пары и желания получают id сразу после посеянных
+        Scenario("DELETE /wishes/{wish_id}", "DELETE", lambda i, rng: (f"/wishes/{args.wishes + i + 1}", None)),
+        Scenario("DELETE /couples/{couple_id}", "DELETE", lambda i, rng: (f"/couples/{args.couples + i + 1}", None)),
+        Scenario("GET /internal/cache", "GET", lambda i, rng: ("/internal/cache", None)),
+        Scenario("GET /internal/pool", "GET", lambda i, rng: ("/internal/pool", None)),
+        Scenario("GET /metrics", "GET", lambda i, rng: ("/metrics", None)),
+        Scenario("GET /internal/telegram", "GET", lambda i, rng: ("/internal/telegram", None)),
+        Scenario("GET /internal/outbox", "GET", lambda i, rng: ("/internal/outbox", None)),
+        Scenario("GET /internal/ratelimit", "GET", lambda i, rng: ("/internal/ratelimit", None)),
+        Scenario("GET /internal/idempotency", "GET", lambda i, rng: ("/internal/idempotency", None)),
+        Scenario("GET /internal/startup", "GET", lambda i, rng: ("/internal/startup", None)),
+        # На SQLite в памяти импорт отклоняется с 501: замеряется только отказ
+        Scenario("POST /internal/import", "POST", lambda i, rng: ("/internal/import", _import_file(i, rng)), 10, 1),
+        Scenario("GET /export/users.ndjson", "GET", lambda i, rng: ("/export/users.ndjson", None), 3, 1),
+        Scenario("GET /export/couples.ndjson", "GET", lambda i, rng: ("/export/couples.ndjson", None), 3, 1),
+        Scenario("GET /export/wishes.ndjson", "GET", lambda i, rng: ("/export/wishes.ndjson", None), 3, 1),
+    ]
+
+
+def missing_routes(app, names) -> list[str]:
+    """Маршруты приложения, для которых нет сценария"""
+    from fastapi.routing import APIRoute
+
+    routes = (f"{method} {route.path}" for route in app.routes if isinstance(route, APIRoute) for method in route.methods)
+    return sorted(set(routes) - set(names))
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, seed: int, warmup: int
+) -> dict:
+    rng = random.Random(f"{seed}:{scenario.name}")
+    # Запросы строятся заранее, чтобы генерация не попадала в замер
+    plan = [scenario.build(i, rng) for i in range(requests)]
+    if scenario.method == "GET":
+        # Прогрев не меняет данных только для чтения; записи повторять нельзя — id заняты
+        for path, body in plan[:warmup]:
+            await client.get(path)
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    position = 0
+
+    async def worker():
+        nonlocal position
+        while position < len(plan):
+            path, body = plan[position]
+            # Каждый запрос — отдельный пользователь бота (адрес доверенный, см. TRUSTED_PROXIES):
+            # проверка лимитов попадает в замер, но не отказывает
+            headers = {"X-Telegram-User-Id": str(position), **(scenario.headers or {})}
+            position += 1
+            start = time.perf_counter()
+            if isinstance(body, bytes):
+                response = await client.request(scenario.method, path, content=body, headers=headers)
+            else:
+                response = await client.request(scenario.method, path, json=body, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args) -> dict:
+    from benchmarks.seed import seed
+    from main import app
+
+    missing = missing_routes(app, [scenario.name for scenario in scenarios(args)])
+    if missing:
+        raise SystemExit(f"Нет сценариев для маршрутов: {', '.join(missing)}")
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "seed": await seed(args.users, args.couples, args.wishes, args.seed, args.reset),
+        "routes": {},
+    }
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        headers = {"X-Internal-Token": os.environ["INTERNAL_TOKEN"]}
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None, headers=headers) as client:
+            for scenario in scenarios(args):
+                if args.only and args.only not in scenario.name:
+                    continue
+                requests = scenario.requests or args.requests
+                concurrency = scenario.concurrency or args.concurrency
+                result = await run_scenario(client, scenario, requests, concurrency, args.seed, args.warmup)
+                report["routes"][scenario.name] = result
+                print(
+                    f"{scenario.name:40} {result['throughput_rps']:9.1f} rps  "
+                    f"p50 {result['p50_ms']:7.2f}  p95 {result['p95_ms']:7.2f}  p99 {result['p99_ms']:7.2f} ms  "
+                    f"{result['statuses']}",
+                    file=sys.stderr,
+                )
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--couples", type=int, default=4000)
+    parser.add_argument("--wishes", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=500, help="запросов на маршрут")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50, help="неучитываемых запросов перед замером GET-маршрутов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", help="запустить только маршруты, содержащие эту строку")
+    parser.add_argument("--reset", action="store_true", help="разрешить удалить существующие данные")
+    parser.add_argument("--output", help="файл для JSON-отчёта, по умолчанию stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
@@ -0,0 +1,103 @@
+"""Заполнение базы детерминированными данными для бенчмарка.
+
+Пары 1..couples состоят из пользователей 2c-1 и 2c, остальные пользователи без пары.
+Желания распределены по парам случайно, но воспроизводимо для одного и того же seed.
+"""
+import random
+import time
+
+from sqlalchemy import func, insert, select, text
+
+from database.crud import rebuild_wish_summaries
+from database.db import engine
+from database.migrate import ensure_schema
+from database.models import Couple, User, Wish
+
+CHUNK_SIZE = 10000
+
+
+def generate_couples(couples: int):
+    for couple_id in range(1, couples + 1):
+        yield (couple_id,)
+
+def generate_users(users: int, couples: int):
+    for user_id in range(1, users + 1):
+        couple_id = (user_id + 1) // 2 if user_id <= couples * 2 else None
+        yield (user_id, f"user{user_id}", couple_id)
+
+def generate_wishes(wishes: int, couples: int, seed: int):
+    rng = random.Random(seed)
+    for wish_id in range(1, wishes + 1):
+        couple_id = rng.randint(1, couples)
+        yield (
+            wish_id,
+            f"wish {wish_id}",
+            round(rng.uniform(1, 100000), 2),
+            rng.randint(1, 10**8),
+            f"https://example.com/item/{wish_id}",
+            couple_id,
+            couple_id * 2 - rng.randint(0, 1),
+        )
+
+
+async def _copy(conn, table: str, columns: list[str], records):
+    """COPY для Postgres, пачки executemany для остальных бэкендов"""
+    if conn.dialect.name == "postgresql":
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(table, records=records, columns=columns)
+        return
+    model = {"couples": Couple, "user": User, "wishes": Wish}[table]
+    chunk = []
+    for record in records:
+        chunk.append(dict(zip(columns, record)))
+        if len(chunk) == CHUNK_SIZE:
+            await conn.execute(insert(model), chunk)
+            chunk = []
+    if chunk:
+        await conn.execute(insert(model), chunk)
+
+
+async def seed(users: int, couples: int, wishes: int, seed: int, reset: bool) -> dict:
+    if couples * 2 > users:
+        raise ValueError("В каждой паре два пользователя: users должно быть не меньше 2 * couples")
+    if wishes and not couples:
+        raise ValueError("Желаниям нужна хотя бы одна пара")
+
+    started = time.perf_counter()
+    await ensure_schema()
+    async with engine.begin() as conn:
+        existing = await conn.scalar(select(func.count()).select_from(User))
+        if existing and not reset:
+            raise RuntimeError("База не пустая: бенчмарк удаляет все данные, запустите с --reset")
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text('TRUNCATE wishes, "user", couples RESTART IDENTITY CASCADE'))
+        else:
+            for table in ("wishes", "user", "couples"):
+                await conn.execute(text(f'DELETE FROM "{table}"'))
+
+    # Отдельные транзакции на таблицу, чтобы не держать одну гигантскую
+    async with engine.begin() as conn:
+        await _copy(conn, "couples", ["id"], generate_couples(couples))
+    async with engine.begin() as conn:
+        await _copy(conn, "user", ["id", "username", "couple_id"], generate_users(users, couples))
+    async with engine.begin() as conn:
+        await _copy(
+            conn,
+            "wishes",
+            ["id", "name", "price", "article", "url", "couple_id", "user_added_id"],
+            generate_wishes(wishes, couples, seed),
+        )
+        if conn.dialect.name == "postgresql":
+            # После COPY с явными id последовательности нужно догнать
+            for table in ("couples", "wishes"):
+                await conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+                ))
+    # Сводки желаний COPY в обход crud не обновляет
+    await rebuild_wish_summaries()
+    if engine.dialect.name == "postgresql":
+        async with engine.begin() as conn:
+            await conn.execute(text("ANALYZE"))
+
+    return {"users": users, "couples": couples, "wishes": wishes, "seconds": time.perf_counter() - started}
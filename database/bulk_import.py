@@ -0,0 +1,317 @@
+"""Импорт пар, пользователей и желаний из CSV или NDJSON.
+
+Каждая строка файла — одна запись с полем type: couple, user или wish, остальные
+поля как в выгрузке /export. В CSV первая строка — заголовок с именами полей,
+переносы строк внутри полей не поддерживаются.
+
+Импорт идёт в три этапа на одном соединении:
+
+1. Строки разбираются потоком и пачками по IMPORT_CHUNK_SIZE копируются во временную
+   таблицу import_staging: в Postgres через COPY, в остальных бэкендах через executemany.
+2. Проверки запросами сразу по всей таблице: повторы id в файле, id, которые уже есть
+   в базе, ссылки на пары и пользователей, которых нет ни в базе, ни в файле.
+   Строка с ошибкой помечается и дальше не идёт.
+3. Проверенные строки переносятся в couples, user и wishes пачками, каждая в своей
+   транзакции, вместе со сводками желаний.
+
+Память ограничена одной пачкой строк. Уведомления партнёрам импорт не создаёт.
+"""
+import csv
+import logging
+from typing import IO, AsyncIterable, AsyncIterator
+
+import orjson
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import (
+    Column, Float, Integer, MetaData, String, Table, and_, cast, exists, func, literal, literal_column, select,
+    text, update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+
+from database.cache import invalidate_all_couples
+from database.db import engine, session
+from database.dto import ImportRecord
+from database.models import Couple, User, Wish, WishSummary, new_nonce
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 10000
+FORMATS = ("ndjson", "csv")
+
+SQLITE = engine.dialect.name == "sqlite"
+insert = sqlite.insert if SQLITE else postgresql.insert
+least = func.min if SQLITE else func.least
+greatest = func.max if SQLITE else func.greatest
+
+STAGING_COLUMNS = ("line", "kind", "id", "username", "couple_id", "name", "price", "article", "url", "user_added_id")
+# Отдельные метаданные: временная таблица не входит в схему alembic
+staging = Table(
+    "import_staging",
+    MetaData(),
+    Column("line", Integer, primary_key=True),
+    Column("kind", String, nullable=False),
+    Column("id", Integer),
+    Column("username", String),
+    Column("couple_id", Integer),
+    Column("name", String),
+    Column("price", Float),
+    Column("article", Integer),
+    Column("url", String),
+    Column("user_added_id", Integer),
+    Column("error", String),
+    prefixes=["TEMPORARY"],
+)
+# Создаются после загрузки: COPY в таблицу без индексов быстрее
+STAGING_INDEXES = (
+    "CREATE INDEX ix_import_staging_kind_id ON import_staging (kind, id)",
+    "CREATE INDEX ix_import_staging_kind_line ON import_staging (kind, line)",
+)
+record_adapter = TypeAdapter(ImportRecord)
+
+
+async def file_lines(file: IO[str]) -> AsyncIterator[str]:
+    """Строки открытого файла: читаются по одной, файл целиком в память не попадает"""
+    for line in file:
+        yield line
+
+async def _parse(lines: AsyncIterable[str], fmt: str):
+    """(номер строки, запись или None, ошибка) для каждой непустой строки"""
+    header = None
+    number = 0
+    async for line in lines:
+        number += 1
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        try:
+            if fmt == "csv":
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = values
+                    continue
+                if len(values) != len(header):
+                    raise ValueError(f"ожидалось {len(header)} полей, а не {len(values)}")
+                # Пустое поле в CSV — отсутствующее значение
+                data = {name: value for name, value in zip(header, values) if value != ""}
+            else:
+                data = orjson.loads(line)
+            yield number, record_adapter.validate_python(data), None
+        except ValidationError as e:
+            error = e.errors()[0]
+            field = ".".join(map(str, error["loc"]))
+            yield number, None, f"{field}: {error['msg']}" if field else error["msg"]
+        except ValueError as e:
+            # orjson.JSONDecodeError и ошибки csv — подклассы ValueError
+            yield number, None, str(e)
+
+
+async def _stage(conn, rows: list[tuple]):
+    if not rows:
+        return
+    if conn.dialect.name == "postgresql":
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table("import_staging", records=rows, columns=STAGING_COLUMNS)
+    else:
+        await conn.execute(staging.insert(), [dict(zip(STAGING_COLUMNS, row)) for row in rows])
+    await conn.commit()
+
+def _staging_row(number: int, record) -> tuple:
+    fields = record.model_dump()
+    return (number, fields.pop("type"), *(fields.get(name) for name in STAGING_COLUMNS[2:]))
+
+
+def _unchecked(kind: str):
+    return and_(staging.c.kind == kind, staging.c.error.is_(None))
+
+def _reject(condition, error):
+    return update(staging).where(staging.c.error.is_(None), condition).values(error=error)
+
+def _staged_valid(kind: str, column):
+    """Есть ли в файле прошедшая проверки запись вида kind с id = column"""
+    other = staging.alias("other")
+    return exists().where(other.c.kind == kind, other.c.id == column, other.c.error.is_(None))
+
+def _validations():
+    """Проверки по порядку: ссылки проверяются после того, как отсеяны сами пары и пользователи"""
+    earlier = staging.alias("earlier")
+    duplicate = exists().where(earlier.c.kind == staging.c.kind, earlier.c.id == staging.c.id, earlier.c.line < staging.c.line)
+    missing_couple = and_(
+        staging.c.couple_id.is_not(None),
+        ~exists().where(Couple.id == staging.c.couple_id),
+        ~_staged_valid("couple", staging.c.couple_id),
+    )
+    return (
+        _reject(and_(staging.c.id.is_not(None), duplicate), "id уже встречался в файле выше"),
+        _reject(and_(staging.c.kind == "couple", exists().where(Couple.id == staging.c.id)), "пара уже существует"),
+        _reject(and_(staging.c.kind == "user", exists().where(User.id == staging.c.id)), "пользователь уже существует"),
+        _reject(and_(staging.c.kind == "wish", exists().where(Wish.id == staging.c.id)), "желание уже существует"),
+        _reject(and_(staging.c.kind == "user", missing_couple), "нет пары " + cast(staging.c.couple_id, String)),
+        _reject(and_(staging.c.kind == "wish", missing_couple), "нет пары " + cast(staging.c.couple_id, String)),
+        _reject(
+            and_(
+                staging.c.kind == "wish",
+                ~exists().where(User.id == staging.c.user_added_id),
+                ~_staged_valid("user", staging.c.user_added_id),
+            ),
+            "нет пользователя " + cast(staging.c.user_added_id, String),
+        ),
+    )
+
+
+def _merge_statements(kind: str, chunk):
+    """Вставки пачки строк вида kind"""
+    # Python-умолчание nonce в INSERT ... SELECT не подставляется: одного значения на пачку достаточно
+    if kind == "couple":
+        return [insert(Couple).from_select(["id", "nonce"], select(staging.c.id, literal(new_nonce())).where(chunk))]
+    if kind == "user":
+        return [insert(User).from_select(
+            ["id", "username", "couple_id", "nonce"],
+            select(staging.c.id, staging.c.username, staging.c.couple_id, literal(new_nonce())).where(chunk),
+        )]
+    columns = ["name", "price", "article", "url", "couple_id", "user_added_id"]
+    values = [staging.c[name] for name in columns]
+    return [
+        insert(Wish).from_select(["id", *columns], select(staging.c.id, *values).where(chunk, staging.c.id.is_not(None))),
+        # Без id желание получает значение из последовательности
+        insert(Wish).from_select(columns, select(*values).where(chunk, staging.c.id.is_(None))),
+    ]
+
+def _add_summaries(chunk):
+    """Добавляет вставленные желания пачки к сводкам, как _add_to_summaries в crud"""
+    aggregate = select(
+        staging.c.couple_id, staging.c.user_added_id,
+        func.count(), func.sum(staging.c.price), func.min(staging.c.price), func.max(staging.c.price),
+    ).where(chunk).group_by(staging.c.couple_id, staging.c.user_added_id)\
+        .order_by(staging.c.couple_id, staging.c.user_added_id)
+    query = insert(WishSummary).from_select(
+        ["couple_id", "user_added_id", "count", "total", "min_price", "max_price"], aggregate
+    )
+    return query.on_conflict_do_update(
+        index_elements=[WishSummary.couple_id, WishSummary.user_added_id],
+        set_={
+            "count": WishSummary.count + query.excluded.count,
+            "total": WishSummary.total + query.excluded.total,
+            "min_price": least(WishSummary.min_price, query.excluded.min_price),
+            "max_price": greatest(WishSummary.max_price, query.excluded.max_price),
+        },
+    )
+
+async def _merge_chunk(conn, kind: str, after: int, upto: int) -> int:
+    """Переносит строки вида kind из диапазона (after, upto] одной транзакцией, возвращает число вставленных"""
+    chunk = and_(_unchecked(kind), staging.c.line > after, staging.c.line <= upto)
+    try:
+        inserted = set()
+        for statement in _merge_statements(kind, chunk):
+            result = await conn.execute(statement.on_conflict_do_nothing().returning(literal_column("id")))
+            inserted.update(result.scalars())
+        # Проверки прошли раньше, но приложение могло за это время занять id: такие строки не вставились
+        staged = (await conn.execute(select(staging.c.line, staging.c.id).where(chunk, staging.c.id.is_not(None)))).all()
+        taken = [line for line, id_ in staged if id_ not in inserted]
+        if taken:
+            await conn.execute(_reject(staging.c.line.in_(taken), "id занят во время импорта"))
+        if kind == "wish":
+            await conn.execute(_add_summaries(chunk))
+        await conn.commit()
+    except DBAPIError as e:
+        # Например, пару удалили после проверок: пачка откатывается целиком, импорт продолжается
+        await conn.rollback()
+        logger.warning("Import chunk of %s lines %d..%d failed: %s", kind, after + 1, upto, e.orig)
+        await conn.execute(_reject(chunk, "ошибка вставки: " + str(e.orig).splitlines()[0]))
+        await conn.commit()
+        return 0
+    return len(inserted)
+
+
+async def _merge(conn, kind: str):
+    """Переносит строки вида kind пачками, отдаёт число перенесённых после каждой"""
+    last = await conn.scalar(select(func.max(staging.c.line)).where(_unchecked(kind)))
+    after, merged = 0, 0
+    while last is not None and after < last:
+        # Граница пачки — номер IMPORT_CHUNK_SIZE-й строки после after
+        upto = await conn.scalar(
+            select(staging.c.line)
+            .where(_unchecked(kind), staging.c.line > after)
+            .order_by(staging.c.line)
+            .offset(IMPORT_CHUNK_SIZE - 1)
+            .limit(1)
+        ) or last
+        merged += await _merge_chunk(conn, kind, after, upto)
+        after = upto
+        yield merged
+
+
+async def import_wishlists(lines: AsyncIterable[str], fmt: str = "ndjson") -> AsyncIterator[dict]:
+    """Импортирует файл, отдавая события по ходу работы.
+
+    {"stage": ..., "rows": n} — прогресс этапа, {"line": n, "error": ...} — отклонённая
+    строка, последнее событие {"stage": "done", ...} — итог.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Формат импорта: {', '.join(FORMATS)}")
+    totals = {"couples": 0, "users": 0, "wishes": 0, "errors": 0}
+    async with engine.connect() as conn:
+        await conn.run_sync(staging.create)
+        await conn.commit()
+        try:
+            rows, staged = [], 0
+            async for number, record, error in _parse(lines, fmt):
+                if error is not None:
+                    totals["errors"] += 1
+                    yield {"line": number, "error": error}
+                    continue
+                rows.append(_staging_row(number, record))
+                if len(rows) == IMPORT_CHUNK_SIZE:
+                    await _stage(conn, rows)
+                    staged += len(rows)
+                    rows = []
+                    yield {"stage": "staging", "rows": staged}
+            await _stage(conn, rows)
+            staged += len(rows)
+            yield {"stage": "staging", "rows": staged}
+
+            for index in STAGING_INDEXES:
+                await conn.execute(text(index))
+            if conn.dialect.name == "postgresql":
+                # Временные таблицы autovacuum не анализирует, а без статистики проверки пойдут перебором
+                await conn.execute(text("ANALYZE import_staging"))
+            for statement in _validations():
+                await conn.execute(statement)
+            await conn.commit()
+            yield {"stage": "validation", "rows": staged}
+
+            for kind, total in (("couple", "couples"), ("user", "users"), ("wish", "wishes")):
+                async for merged in _merge(conn, kind):
+                    totals[total] = merged
+                    yield {"stage": total, "rows": merged}
+
+            if conn.dialect.name == "postgresql":
+                # Явные id из файла обходят последовательности
+                for table in ("couples", "wishes"):
+                    await conn.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                        f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+                    ))
+                await conn.commit()
+
+            result = await conn.stream(
+                select(staging.c.line, staging.c.kind, staging.c.error)
+                .where(staging.c.error.is_not(None))
+                .order_by(staging.c.line)
+                .execution_options(yield_per=IMPORT_CHUNK_SIZE)
+            )
+            async for line, kind, error in result:
+                totals["errors"] += 1
+                yield {"line": line, "type": kind, "error": error}
+            await conn.commit()
+        finally:
+            # Соединение вернётся в пул, а временная таблица живёт, пока живёт соединение
+            await conn.rollback()
+            await conn.run_sync(staging.drop, checkfirst=True)
+            await conn.commit()
+
+    # Кэш пар и ETag во всех воркерах: какие пары изменились, не отслеживается
+    async with session() as sess:
+        invalidate_all_couples(sess)
+        await sess.commit()
+    yield {"stage": "done", **totals}
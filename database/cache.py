@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database.config import settings
+
+
+class LRUCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        # Растёт при каждой инвалидации: значение, прочитанное из БД до неё,
+        # могло устареть, и класть его в кэш нельзя
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, epoch: int):
+        """Кладёт значение, если с момента чтения (epoch) ничего не инвалидировалось"""
+        if epoch != self.epoch:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        self.epoch += 1
+        for key in keys:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.epoch += 1
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+# (ETag, сериализованный CoupleDetail) по id пары
+couple_cache = LRUCache(settings.COUPLE_CACHE_SIZE, settings.COUPLE_CACHE_TTL)
+
+ALL = object()
+
+
+def invalidate_couples(sess, *couple_ids):
+    """Запоминает пары, изменённые в транзакции; из кэша они уйдут после коммита"""
+    changed = sess.info.setdefault("changed_couples", set())
+    changed.update(couple_id for couple_id in couple_ids if couple_id)
+
+def invalidate_all_couples(sess):
+    """Для записей, после которых нельзя точно сказать, какие пары затронуты"""
+    sess.info.setdefault("changed_couples", set()).add(ALL)
+
+
+@event.listens_for(Session, "after_commit")
+def _evict_after_commit(sess):
+    changed = sess.info.pop("changed_couples", None)
+    if not changed:
+        return
+    if ALL in changed:
+        couple_cache.clear()
+    else:
+        couple_cache.invalidate(*changed)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_after_rollback(sess, previous_transaction):
+    sess.info.pop("changed_couples", None)
@@ -1,21 +1,119 @@
-from database.models import User, Couple, Wish
-from database.db import session
+import logging
+from contextlib import asynccontextmanager
+from typing import NamedTuple
 
-from sqlalchemy import func, select
-from sqlalchemy.orm import selectinload
+from database.models import SEARCH_CONFIG, User, Couple, Wish, WishSummary, search_document
+from database.db import engine, replica_read, session
+from database.cache import ALL, invalidate_couples
+from database import invalidation  # noqa: F401 — рассылает NOTIFY об изменённых парах при коммите
+from database.outbox import PREVIEW_NAMES, notify_partners
+from database.singleflight import coalesced
 
-from exceptions import *
+from sqlalchemy import Integer, String, and_, case, cast, delete, event, exists, func, literal, null, or_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+
+from exceptions import (
+    CoupleCreationError,
+    CoupleDeleteError,
+    CoupleUpdateError,
+    NoCoupleFoundError,
+    NoUserFoundError,
+    NoWishFoundError,
+    UserAlreadyExistsError,
+    UserCreationError,
+    UserDeleteError,
+    UserHasWishesError,
+    UserUpdateError,
+    WishCreationError,
+    WishDeleteError,
+    WishUpdateError,
+)
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 1000
+# Три колонки на строку — далеко от лимита в 32767 параметров на запрос
+BULK_CHUNK_SIZE = 1000
+
+# Колонки в порядке полей DTO Users, UserInCouple и Wish: из строк сразу собирается JSON
+USER_COLUMNS = (User.id, User.username, User.couple_id)
+COUPLE_USER_COLUMNS = (User.id, User.username)
+WISH_COLUMNS = (Wish.name, Wish.price, Wish.id, Wish.article, Wish.url, Wish.couple_id, Wish.user_added_id)
+
+# В SQLite нет FOR UPDATE, xmax и UPDATE/DELETE внутри WITH: для этих запросов есть запасные пути
+SQLITE = engine.dialect.name == "sqlite"
+# INSERT ... ON CONFLICT у обоих диалектов с одинаковым интерфейсом
+insert = sqlite.insert if SQLITE else postgresql.insert
+# В SQLite min и max от двух аргументов — скалярные функции, least и greatest нет
+least = func.min if SQLITE else func.least
+greatest = func.max if SQLITE else func.greatest
+# Поиск ранжирует не больше стольких совпадений: иначе частое слово в 10M названий
+# означало бы вычислить ранг каждого. Дальше этого числа результатов страницы не идут
+SEARCH_CANDIDATES = 1000
+# Разница сумм меньше копейки — накопленная ошибка float, а не расхождение сводки
+SUMMARY_TOTAL_TOLERANCE = 0.01
+
+
+@asynccontextmanager
+async def _session(sess: AsyncSession | None):
+    """Сессия запроса, если её передали, иначе новая на время вызова"""
+    if sess is not None:
+        yield sess
+        return
+    async with session() as new_sess:
+        yield new_sess
+
+async def _begin_immediate(sess: AsyncSession):
+    """SQLite: сразу берёт блокировку записи вместо FOR UPDATE.
+
+    Иначе драйвер начинает транзакцию только перед первой записью, и прочитанное
+    до неё мог успеть изменить другой писатель.
+    """
+    conn = await sess.connection()
+    raw = await conn.get_raw_connection()
+    if not raw.driver_connection.in_transaction:
+        await sess.execute(text("BEGIN IMMEDIATE"))
+
+@event.listens_for(Session, "before_commit")
+def _bump_couple_versions(sess):
+    # Всё, из-за чего пара уходит из кэша, меняет и её ETag
+    changed = sess.info.get("changed_couples")
+    couple_ids = [couple_id for couple_id in changed or () if couple_id is not ALL]
+    if couple_ids:
+        sess.execute(update(Couple).where(Couple.id.in_(couple_ids)).values(version=Couple.version + 1))
+
+def _page(rows, limit: int):
+    """Отрезает лишнюю строку и вычисляет курсор следующей страницы"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
 
 # ----- User Cruds -----
 
-async def get_all_users_from_db():
-    async with session() as sess:
-        query = select(User)
+@coalesced
+@replica_read
+@timed
+async def get_all_users_from_db(limit: int = 100, after: int | None = None, sess: AsyncSession | None = None):
+    """Страница пользователей строками без ORM-объектов"""
+    async with _session(sess) as sess:
+        # Keyset-пагинация по первичному ключу: берём на одну строку больше,
+        # чтобы понять, есть ли следующая страница
+        query = select(*USER_COLUMNS).order_by(User.id).limit(limit + 1)
+        if after is not None:
+            query = query.where(User.id > after)
         result = await sess.execute(query)
-        return result.scalars().all()
+        return _page(result.all(), limit)
 
-async def get_user_from_db(user_id: int) -> User:
-    async with session() as sess:
+@coalesced
+@replica_read
+@timed
+async def get_user_from_db(user_id: int, sess: AsyncSession | None = None) -> User:
+    async with _session(sess) as sess:
         query = select(User).filter_by(id=user_id)
         result = await sess.execute(query)
         res: User | None = result.scalar_one_or_none()
@@ -23,87 +121,290 @@ async def get_user_from_db(user_id: int) -> User:
             return res
         raise NoUserFoundError(user_id)
     
-async def add_user_to_db(user_id: int, username: str, couple_id: int = None):
-    async with session() as sess:
+@timed
+async def add_user_to_db(user_id: int, username: str, couple_id: int = None, sess: AsyncSession | None = None):
+    async with _session(sess) as sess:
+        # Один INSERT ... ON CONFLICT DO NOTHING вместо проверки и вставки:
+        # один запрос и никакой гонки между одновременными регистрациями
+        query = insert(User)\
+            .values(id=user_id, username=username, couple_id=couple_id)\
+            .on_conflict_do_nothing(index_elements=[User.id])\
+            .returning(User)
         try:
-            await get_user_from_db(user_id)
+            new_user = await sess.scalar(query)
+            if new_user:
+                invalidate_couples(sess, couple_id)
+            await sess.commit()
+        except:
+            await sess.rollback()
+            raise UserCreationError()
+        if new_user is None:
             raise UserAlreadyExistsError()
-        except NoUserFoundError:
-            new_user = User(id=user_id, username=username, couple_id=couple_id)
-            sess.add(new_user)
-            try:
-                await sess.commit()
-                return new_user
-            except:
-                await sess.rollback()
-                raise UserCreationError()
-        
-async def update_user_in_db(user_id: int, username: str, couple_id: int):
-    async with session() as sess:
-        user = await sess.get(User, user_id)
-        if user:
-            user.username = username if username else user.username
-            if not couple_id:
-                # Явно загружаем пару и её пользователей
-                stmt = select(Couple).where(Couple.id == user.couple_id).with_for_update()
-                result = await sess.scalars(stmt)
-                couple = result.one_or_none()
-                print(couple.id)
-                if couple:
-                    # Подсчитываем, сколько пользователей в паре (до удаления)
-                    user_count = await sess.scalar(
-                        select(func.count()).select_from(User).where(User.couple_id == couple.id)
-                    )
-                    if user_count <= 1:
-                        await sess.delete(couple)
-            try:
-                await sess.commit()
-            except:
-                await sess.rollback()
-                raise UserUpdateError()
-        else:
-            raise NoUserFoundError()
+        return new_user
 
-async def delete_user_from_db(user_id: int):
-    async with session() as sess:
-        # Получаем пользователя
-        user = await sess.get(User, user_id)
-        if not user:
-            raise NoUserFoundError(user_id)
+@timed
+async def upsert_users_to_db(users: list[dict], overwrite: bool = False, sess: AsyncSession | None = None) -> tuple[list[int], list[int]]:
+    """Вставляет пользователей пачками, возвращает id созданных и уже существовавших.
+
+    С overwrite у существующих пользователей меняются username и couple_id, если он
+    передан; опустевшие прежние пары удаляются, как в update_user_in_db.
+    """
+    # Повторы id внутри одного INSERT ... ON CONFLICT DO UPDATE запрещены, оставляем последний
+    rows = list({user["id"]: user for user in users}.values())
+    created, existing = [], []
+    # id пользователя -> пара, из которой он вышел
+    left = {}
+    # Пары существующих пользователей: в них поменялся username участника
+    previous = set()
+    async with _session(sess) as sess:
+        try:
+            if overwrite and SQLITE:
+                await _begin_immediate(sess)
+            # couple_id перезаписывается только у тех, кто его передал: пачки делятся на два запроса
+            groups = [[user for user in rows if ("couple_id" in user) == moves] for moves in (True, False)] if overwrite else [rows]
+            for group in groups:
+                for start in range(0, len(group), BULK_CHUNK_SIZE):
+                    chunk = group[start:start + BULK_CHUNK_SIZE]
+                    moves = "couple_id" in chunk[0]
+                    query = insert(User).values([{"couple_id": None, **user} for user in chunk])
+                    if not overwrite:
+                        query = query.on_conflict_do_nothing(index_elements=[User.id])
+                        inserted = set(await sess.scalars(query.returning(User.id)))
+                        for user in chunk:
+                            (created if user["id"] in inserted else existing).append(user["id"])
+                        continue
+                    # Прежние пары читаются под блокировкой строк, в SQLite — под блокировкой записи
+                    found = select(User.id, User.couple_id).where(User.id.in_([user["id"] for user in chunk]))
+                    if not SQLITE:
+                        found = found.order_by(User.id).with_for_update()
+                    found = dict((await sess.execute(found)).all())
+                    set_ = {"username": query.excluded.username, "version": User.version + 1}
+                    if moves:
+                        set_["couple_id"] = query.excluded.couple_id
+                    await sess.execute(query.on_conflict_do_update(index_elements=[User.id], set_=set_))
+                    for user in chunk:
+                        if user["id"] not in found:
+                            created.append(user["id"])
+                            continue
+                        existing.append(user["id"])
+                        old_couple_id = found[user["id"]]
+                        previous.add(old_couple_id)
+                        if moves and old_couple_id is not None and old_couple_id != user["couple_id"]:
+                            left[user["id"]] = old_couple_id
+            for user_id, couple_id in left.items():
+                notify_partners(sess, couple_id, user_id, "partner_left", {"user_id": user_id})
+            await _drop_orphan_couples(sess, set(left.values()))
+            invalidate_couples(sess, *(user.get("couple_id") for user in rows), *previous)
+            await sess.commit()
+        except:
+            await sess.rollback()
+            raise UserCreationError()
+    return created, existing
 
-        couple = None
-        if user.couple_id:
-            # Явно загружаем пару и её пользователей
-            stmt = select(Couple).where(Couple.id == user.couple_id).with_for_update()
-            result = await sess.scalars(stmt)
-            couple = result.one_or_none()
-
-            if couple:
-                # Подсчитываем, сколько пользователей в паре (до удаления)
-                user_count = await sess.scalar(
-                    select(func.count()).select_from(User).where(User.couple_id == couple.id)
-                )
-                if user_count <= 1:
-                    await sess.delete(couple)
-
-        # Удаляем пользователя
+async def _drop_orphan_couples(sess: AsyncSession, couple_ids):
+    """Удаляет пары из couple_ids, в которых не осталось участников, вместе с их желаниями"""
+    if not couple_ids:
+        return
+    orphans = select(Couple.id).where(Couple.id.in_(couple_ids), ~exists().where(User.couple_id == Couple.id))
+    if not SQLITE:
+        orphans = orphans.order_by(Couple.id).with_for_update(of=Couple)
+    orphan_ids = list(await sess.scalars(orphans))
+    if orphan_ids:
+        await sess.execute(delete(Wish).where(Wish.couple_id.in_(orphan_ids)))
+        await sess.execute(delete(Couple).where(Couple.id.in_(orphan_ids)))
+
+def _lock_members(user_id: int):
+    """CTE, блокирующий строку пользователя и строки его партнёров в порядке id.
+
+    Партнёр, который успел выйти из пары или удалиться, пока мы ждали блокировку,
+    в выборку не попадёт — на этом держится проверка, осталась ли пара пустой.
+    """
+    own_couple = select(User.couple_id).where(User.id == user_id).scalar_subquery()
+    return select(User.id, User.couple_id)\
+        .where(or_(User.id == user_id, User.couple_id == own_couple))\
+        .order_by(User.id)\
+        .with_for_update()\
+        .cte("members")
+
+def _drop_orphan_couple(members, changed, user_id: int):
+    """Дописывает к запросу удаление прежней пары пользователя и её желаний, если в ней никого не осталось"""
+    orphan = select(changed.c.old_couple_id.label("id"))\
+        .where(
+            changed.c.old_couple_id.is_not(None),
+            changed.c.old_couple_id.is_distinct_from(changed.c.new_couple_id),
+            ~exists().where(members.c.id != user_id),
+        )\
+        .cte("orphan")
+    dropped_wishes = delete(Wish).where(Wish.couple_id.in_(select(orphan.c.id))).cte("dropped_wishes")
+    dropped_couple = delete(Couple).where(Couple.id.in_(select(orphan.c.id))).returning(Couple.id).cte("dropped_couple")
+    return select(changed.c.old_couple_id, changed.c.new_couple_id, select(dropped_couple.c.id).scalar_subquery())\
+        .add_cte(dropped_wishes)
+
+class _ChangedUser(NamedTuple):
+    old_couple_id: int | None
+    new_couple_id: int | None
+    # Пары, из которых удалены желания удалённого пользователя
+    wish_couple_ids: list[int] | None = None
+
+def _notify_left(sess: AsyncSession, row, user_id: int):
+    if row.old_couple_id is not None and row.old_couple_id != row.new_couple_id:
+        notify_partners(sess, row.old_couple_id, user_id, "partner_left", {"user_id": user_id})
+
+async def _change_user_sqlite(sess: AsyncSession, user_id: int, username: str | None, couple_id: int | None, remove: bool, purge_wishes: bool = False):
+    """То же, что запросы с CTE выше, отдельными запросами под блокировкой записи SQLite"""
+    await _begin_immediate(sess)
+    user = await sess.get(User, user_id, populate_existing=True)
+    if user is None:
+        return None
+    old_couple_id = user.couple_id
+    wish_couple_ids = None
+    if remove:
+        if purge_wishes:
+            wish_couple_ids = list(set(await sess.scalars(
+                delete(Wish).where(Wish.user_added_id == user_id).returning(Wish.couple_id)
+            )))
+            await sess.execute(delete(WishSummary).where(WishSummary.user_added_id == user_id))
+        if old_couple_id is not None and not await sess.scalar(
+            select(exists().where(User.couple_id == old_couple_id, User.id != user_id))
+        ):
+            # Желания опустевшей пары уходят раньше пользователя, иначе их держит внешний ключ
+            await sess.execute(delete(Wish).where(Wish.couple_id == old_couple_id))
         await sess.delete(user)
+        new_couple_id = None
+    else:
+        user.username = username or user.username
+        if couple_id is not None:
+            user.couple_id = couple_id or None
+        new_couple_id = user.couple_id
+        user.version = User.version + 1
+    await sess.flush()
+    if old_couple_id is not None and old_couple_id != new_couple_id:
+        await _drop_orphan_couples(sess, [old_couple_id])
+    return _ChangedUser(old_couple_id, new_couple_id, wish_couple_ids)
+
+@timed
+async def update_user_in_db(user_id: int, username: str, couple_id: int | None, sess: AsyncSession | None = None):
+    """Меняет username и пару пользователя: None — пара не меняется, 0 — выход из пары.
+
+    Опустевшая прежняя пара удаляется тем же запросом.
+    """
+    async with _session(sess) as sess:
+        try:
+            if SQLITE:
+                row = await _change_user_sqlite(sess, user_id, username, couple_id, remove=False)
+            else:
+                members = _lock_members(user_id)
+                if couple_id is None:
+                    new_couple_id = members.c.couple_id
+                else:
+                    new_couple_id = couple_id or null()
+                changed = update(User)\
+                    .where(User.id == members.c.id, members.c.id == user_id)\
+                    .values(
+                        username=func.coalesce(username or None, User.username),
+                        couple_id=new_couple_id,
+                        version=User.version + 1,
+                    )\
+                    .returning(members.c.couple_id.label("old_couple_id"), User.couple_id.label("new_couple_id"))\
+                    .cte("changed")
+                result = await sess.execute(_drop_orphan_couple(members, changed, user_id))
+                row = result.first()
+            if row:
+                invalidate_couples(sess, row.old_couple_id, row.new_couple_id)
+                _notify_left(sess, row, user_id)
+            await sess.commit()
+        except:
+            await sess.rollback()
+            raise UserUpdateError()
+        if row is None:
+            raise NoUserFoundError(user_id)
+
+@timed
+async def delete_user_from_db(user_id: int, purge_wishes: bool = False, sess: AsyncSession | None = None):
+    """Удаляет пользователя, а вместе с ним опустевшую пару и её желания — одним запросом.
+
+    Если у пользователя остались желания в паре, где есть партнёр, удаление отклоняется
+    с UserHasWishesError; с purge_wishes=True они удаляются вместе с его строками сводок.
+    """
+    async with _session(sess) as sess:
         try:
+            if SQLITE:
+                row = await _change_user_sqlite(sess, user_id, None, None, remove=True, purge_wishes=purge_wishes)
+            else:
+                members = _lock_members(user_id)
+                changed = delete(User)\
+                    .where(User.id.in_(select(members.c.id).where(members.c.id == user_id)))\
+                    .returning(
+                        User.id.label("user_id"),
+                        User.couple_id.label("old_couple_id"),
+                        cast(null(), Integer).label("new_couple_id"),
+                    )\
+                    .cte("changed")
+                query = _drop_orphan_couple(members, changed, user_id)
+                if purge_wishes:
+                    # Ссылаются на changed, поэтому выполняются только после блокировки участников
+                    authored = delete(Wish)\
+                        .where(Wish.user_added_id.in_(select(changed.c.user_id)))\
+                        .returning(Wish.couple_id)\
+                        .cte("authored_wishes")
+                    summaries = delete(WishSummary)\
+                        .where(WishSummary.user_added_id.in_(select(changed.c.user_id)))\
+                        .cte("authored_summaries")
+                    query = query\
+                        .add_cte(summaries)\
+                        .add_columns(select(func.array_agg(authored.c.couple_id.distinct())).scalar_subquery().label("wish_couple_ids"))
+                result = await sess.execute(query)
+                row = result.first()
+            if row:
+                invalidate_couples(sess, row.old_couple_id, *(getattr(row, "wish_couple_ids", None) or ()))
+                _notify_left(sess, row, user_id)
             await sess.commit()
+        except IntegrityError:
+            # Внешний ключ wishes.user_added_id: желания остались в чужой паре
+            await sess.rollback()
+            raise UserHasWishesError()
         except:
             await sess.rollback()
             raise UserDeleteError()
+        if row is None:
+            raise NoUserFoundError(user_id)
 
 # ----- Couple Cruds -----
 
-async def get_all_couples_from_db():
-    async with session() as sess:
-        query = select(Couple).options(selectinload(Couple.users))
-        result = await sess.execute(query)
-        return result.scalars().all()
+async def _users_by_couple(sess: AsyncSession, couple_ids: list[int]) -> dict[int, list[dict]]:
+    """Участники пар одним запросом, сгруппированные по id пары"""
+    users = {couple_id: [] for couple_id in couple_ids}
+    if couple_ids:
+        result = await sess.execute(
+            select(User.couple_id, *COUPLE_USER_COLUMNS).where(User.couple_id.in_(couple_ids)).order_by(User.id)
+        )
+        for couple_id, user_id, username in result:
+            users[couple_id].append({"id": user_id, "username": username})
+    return users
 
-async def get_couple_from_db(couple_id: int) -> Couple:
-    async with session() as sess:
+@coalesced
+@replica_read
+@timed
+async def get_all_couples_from_db(limit: int = 100, after: int | None = None, sess: AsyncSession | None = None):
+    """Страница пар с участниками в виде словарей по схеме CoupleWithUsers"""
+    async with _session(sess) as sess:
+        query = select(Couple.id).order_by(Couple.id).limit(limit + 1)
+        if after is not None:
+            query = query.where(Couple.id > after)
+        couple_ids = (await sess.scalars(query)).all()
+        next_cursor = None
+        if len(couple_ids) > limit:
+            couple_ids = couple_ids[:limit]
+            next_cursor = couple_ids[-1]
+        # Второй запрос вместо selectinload: тоже один на страницу, но без ORM-объектов
+        users = await _users_by_couple(sess, couple_ids)
+        return [{"id": couple_id, "users": users[couple_id]} for couple_id in couple_ids], next_cursor
+
+@coalesced
+@replica_read
+@timed
+async def get_couple_from_db(couple_id: int, sess: AsyncSession | None = None) -> Couple:
+    async with _session(sess) as sess:
         query = select(Couple)\
             .options(selectinload(Couple.users), selectinload(Couple.wishes))\
             .filter_by(id=couple_id)
@@ -113,15 +414,51 @@ async def get_couple_from_db(couple_id: int) -> Couple:
             return res
         raise NoCoupleFoundError()
 
-async def create_couple(user1_id: int, user2_id: int | None = None) -> Couple:
-    async with session() as sess:
+@coalesced
+@replica_read
+@timed
+async def get_couple_detail_from_db(couple_id: int, sess: AsyncSession | None = None) -> dict:
+    """Пара с участниками и желаниями в виде словаря по схеме CoupleDetail"""
+    async with _session(sess) as sess:
+        if not await sess.scalar(select(exists().where(Couple.id == couple_id))):
+            raise NoCoupleFoundError(couple_id)
+        users = await _users_by_couple(sess, [couple_id])
+        wishes = await sess.execute(select(*WISH_COLUMNS).where(Wish.couple_id == couple_id).order_by(Wish.id))
+        return {
+            "id": couple_id,
+            "users": users[couple_id],
+            "wishes": [row._asdict() for row in wishes],
+        }
+
+def _child_versions(model):
+    """Число строк и сумма их версий: вместе с версией пары однозначно задают состояние"""
+    return (
+        select(func.count()).where(model.couple_id == Couple.id).scalar_subquery(),
+        select(func.coalesce(func.sum(model.version), 0)).where(model.couple_id == Couple.id).scalar_subquery(),
+    )
+
+@coalesced
+@replica_read
+@timed
+async def get_couple_etag_from_db(couple_id: int, sess: AsyncSession | None = None) -> str | None:
+    """Строгий ETag пары одним запросом по индексам couple_id, без загрузки строк; None — пары нет"""
+    async with _session(sess) as sess:
+        query = select(Couple.nonce, Couple.version, *_child_versions(User), *_child_versions(Wish)).where(Couple.id == couple_id)
+        row = (await sess.execute(query)).first()
+        if row is None:
+            return None
+        return '"' + ".".join(map(str, row)) + '"'
+
+@timed
+async def create_couple(user1_id: int, user2_id: int | None = None, sess: AsyncSession | None = None) -> Couple:
+    async with _session(sess) as sess:
         # Загружаем пользователей
         user1 = await sess.get(User, user1_id)
         if not user1:
             raise NoUserFoundError(user1_id)
 
         user2 = None
-        if not user2_id:
+        if user2_id:
             user2 = await sess.get(User, user2_id)
             if not user2:
                 raise NoUserFoundError(user2_id)
@@ -131,6 +468,11 @@ async def create_couple(user1_id: int, user2_id: int | None = None) -> Couple:
         if user2:
             users.append(user2)
 
+        # Пользователи уходят из прежних пар
+        invalidate_couples(sess, *(user.couple_id for user in users))
+        for user in users:
+            user.version = User.version + 1
+
         # Создаём пару
         couple = Couple(users=users)
         sess.add(couple)
@@ -141,12 +483,13 @@ async def create_couple(user1_id: int, user2_id: int | None = None) -> Couple:
             return couple
         except Exception as e:
             await sess.rollback()
-            print(f"Error in create_couple: {e}")  # ← для отладки
+            logger.exception("Couple creation failed")
             raise CoupleCreationError() from e
 
         
-async def update_couple_in_db(couple_id: int, user1_id: int, user2_id: int):
-    async with session() as sess:
+@timed
+async def update_couple_in_db(couple_id: int, user1_id: int, user2_id: int, sess: AsyncSession | None = None):
+    async with _session(sess) as sess:
         # Загружаем всё в одной сессии
         couple = await sess.get(Couple, couple_id, options=[selectinload(Couple.users)])
         if not couple:
@@ -162,24 +505,398 @@ async def update_couple_in_db(couple_id: int, user1_id: int, user2_id: int):
 
         # Отвязываем пользователей от старых пар (если нужно — SQLAlchemy сделает сам, но проверим)
         # Просто присваиваем новых пользователей — relationship позаботится об обновлении couple_id
-        couple.users = [user1, user2] if user2 else [user1]
+        invalidate_couples(sess, couple_id, user1.couple_id, user2.couple_id if user2 else None)
+        new_users = [user1, user2] if user2 else [user1]
+        # couple_id меняется и у новых участников, и у тех, кто из пары выходит
+        for user in {*couple.users, *new_users}:
+            user.version = User.version + 1
+        couple.users = new_users
 
         try:
             await sess.commit()
             await sess.refresh(couple)  # Обновляем объект после коммита
         except Exception as e:
             await sess.rollback()
-            print(f"DB Error in update_couple_in_db: {e}")  # ← Для отладки
+            logger.exception("Couple %s update failed", couple_id)
             raise CoupleUpdateError() from e
 
-async def delete_couple_from_db(couple_id: int):
-    async with session() as sess:
+@timed
+async def delete_couple_from_db(couple_id: int, sess: AsyncSession | None = None):
+    async with _session(sess) as sess:
         couple = await sess.get(Couple, couple_id)
         if not couple:
             raise NoCoupleFoundError(couple_id)
         await sess.delete(couple)
+        invalidate_couples(sess, couple_id)
         try:
             await sess.commit()
         except:
             await sess.rollback()
             raise CoupleDeleteError()
+
+# ----- Wish Summaries -----
+# Сводка по паре и автору меняется вместе с желаниями, чтобы её чтение не зависело от их числа
+
+def _summary_key(couple_id: int, user_added_id: int):
+    return WishSummary.couple_id == couple_id, WishSummary.user_added_id == user_added_id
+
+def _recomputed(aggregate, couple_id: int, user_added_id: int):
+    return select(aggregate).where(Wish.couple_id == couple_id, Wish.user_added_id == user_added_id).scalar_subquery()
+
+async def _add_to_summaries(sess: AsyncSession, wishes: list[dict]):
+    """Прибавляет новые желания к сводкам их пар и авторов"""
+    groups = {}
+    for wish in wishes:
+        key = (wish["couple_id"], wish["user_added_id"])
+        price = wish["price"]
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [1, price, price, price]
+        else:
+            group[0] += 1
+            group[1] += price
+            group[2] = min(group[2], price)
+            group[3] = max(group[3], price)
+    # Одинаковый порядок ключей: одновременные вставки блокируют строки сводки без взаимоблокировок
+    rows = [
+        {"couple_id": couple_id, "user_added_id": user_added_id, "count": count, "total": total, "min_price": low, "max_price": high}
+        for (couple_id, user_added_id), (count, total, low, high) in sorted(groups.items())
+    ]
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        query = insert(WishSummary).values(rows[start:start + BULK_CHUNK_SIZE])
+        await sess.execute(query.on_conflict_do_update(
+            index_elements=[WishSummary.couple_id, WishSummary.user_added_id],
+            set_={
+                "count": WishSummary.count + query.excluded.count,
+                "total": WishSummary.total + query.excluded.total,
+                "min_price": least(WishSummary.min_price, query.excluded.min_price),
+                "max_price": greatest(WishSummary.max_price, query.excluded.max_price),
+            },
+        ))
+
+async def _lock_summary(sess: AsyncSession, couple_id: int, user_added_id: int):
+    """Блокирует строку сводки до того, как желание удаляется или меняет цену.
+
+    Пересчёт min и max видит снимок своего запроса: если бы блокировку ждал сам UPDATE,
+    он не увидел бы желаний, закоммиченных за время ожидания. В SQLite писатель один,
+    его блокировку берёт _begin_immediate.
+    """
+    if not SQLITE:
+        await sess.execute(select(WishSummary.count).where(*_summary_key(couple_id, user_added_id)).with_for_update())
+
+async def _remove_from_summary(sess: AsyncSession, couple_id: int, user_added_id: int, price: float):
+    """Вычитает удалённое желание; min и max пересчитываются, только если оно было крайним"""
+    key = _summary_key(couple_id, user_added_id)
+    last = WishSummary.count == 1
+    count = await sess.scalar(
+        update(WishSummary)
+        .where(*key)
+        .values(
+            count=WishSummary.count - 1,
+            # Последнее желание обнуляет сумму точно, без накопленной ошибки float
+            total=case((last, 0.0), else_=WishSummary.total - price),
+            min_price=case(
+                (last, WishSummary.min_price),
+                (WishSummary.min_price == price, _recomputed(func.min(Wish.price), couple_id, user_added_id)),
+                else_=WishSummary.min_price,
+            ),
+            max_price=case(
+                (last, WishSummary.max_price),
+                (WishSummary.max_price == price, _recomputed(func.max(Wish.price), couple_id, user_added_id)),
+                else_=WishSummary.max_price,
+            ),
+        )
+        .returning(WishSummary.count)
+    )
+    if count == 0:
+        await sess.execute(delete(WishSummary).where(*key))
+
+async def _reprice_in_summary(sess: AsyncSession, couple_id: int, user_added_id: int, old: float, new: float):
+    await sess.execute(
+        update(WishSummary)
+        .where(*_summary_key(couple_id, user_added_id))
+        .values(
+            total=WishSummary.total - old + new,
+            min_price=case(
+                (WishSummary.min_price >= new, new),
+                (WishSummary.min_price == old, _recomputed(func.min(Wish.price), couple_id, user_added_id)),
+                else_=WishSummary.min_price,
+            ),
+            max_price=case(
+                (WishSummary.max_price <= new, new),
+                (WishSummary.max_price == old, _recomputed(func.max(Wish.price), couple_id, user_added_id)),
+                else_=WishSummary.max_price,
+            ),
+        )
+    )
+
+def _price_stats(count: int, total: float, low: float | None, high: float | None) -> dict:
+    return {
+        "count": count,
+        "total": total,
+        "min_price": low,
+        "max_price": high,
+        "avg_price": total / count if count else None,
+    }
+
+@coalesced
+@replica_read
+@timed
+async def get_couple_summary_from_db(couple_id: int, sess: AsyncSession | None = None) -> dict:
+    """Сводка по желаниям пары в виде словаря по схеме CoupleSummary: строка на автора, сами желания не читаются"""
+    async with _session(sess) as sess:
+        rows = (await sess.execute(
+            select(WishSummary.user_added_id, WishSummary.count, WishSummary.total, WishSummary.min_price, WishSummary.max_price)
+            .where(WishSummary.couple_id == couple_id)
+            .order_by(WishSummary.user_added_id)
+        )).all()
+        # Строка сводки есть только у существующей пары
+        if not rows and not await sess.scalar(select(exists().where(Couple.id == couple_id))):
+            raise NoCoupleFoundError(couple_id)
+        stats = _price_stats(
+            sum(row.count for row in rows),
+            sum(row.total for row in rows),
+            min((row.min_price for row in rows), default=None),
+            max((row.max_price for row in rows), default=None),
+        )
+        return {
+            **stats,
+            "id": couple_id,
+            "users": [
+                {**_price_stats(row.count, row.total, row.min_price, row.max_price), "user_id": row.user_added_id}
+                for row in rows
+            ],
+        }
+
+async def rebuild_wish_summaries(couple_id: int | None = None) -> dict:
+    """Пересчитывает сводки из желаний — всех пар или одной — и сообщает, сколько строк расходилось"""
+    async with session() as sess:
+        if SQLITE:
+            await _begin_immediate(sess)
+        else:
+            # Записи желаний ждут, пока идёт пересчёт, чтения сводки — нет
+            await sess.execute(text("LOCK TABLE wish_summaries IN EXCLUSIVE MODE"))
+        actual = select(
+            Wish.couple_id,
+            Wish.user_added_id,
+            func.count().label("count"),
+            func.sum(Wish.price).label("total"),
+            func.min(Wish.price).label("min_price"),
+            func.max(Wish.price).label("max_price"),
+        ).group_by(Wish.couple_id, Wish.user_added_id)
+        stored = select(WishSummary)
+        if couple_id is not None:
+            actual = actual.where(Wish.couple_id == couple_id)
+            stored = stored.where(WishSummary.couple_id == couple_id)
+        actual, stored = actual.subquery(), stored.subquery()
+
+        drifted = await sess.scalar(
+            select(func.count())
+            .select_from(actual.join(
+                stored,
+                and_(actual.c.couple_id == stored.c.couple_id, actual.c.user_added_id == stored.c.user_added_id),
+                full=True,
+            ))
+            .where(or_(
+                actual.c.count.is_distinct_from(stored.c.count),
+                actual.c.min_price.is_distinct_from(stored.c.min_price),
+                actual.c.max_price.is_distinct_from(stored.c.max_price),
+                func.abs(actual.c.total - stored.c.total) > SUMMARY_TOTAL_TOLERANCE,
+            ))
+        )
+        deleted = delete(WishSummary)
+        if couple_id is not None:
+            deleted = deleted.where(WishSummary.couple_id == couple_id)
+        await sess.execute(deleted)
+        columns = ["couple_id", "user_added_id", "count", "total", "min_price", "max_price"]
+        result = await sess.execute(
+            insert(WishSummary).from_select(columns, select(*(actual.c[column] for column in columns)))
+        )
+        await sess.commit()
+        return {"rows": result.rowcount, "drifted": drifted}
+
+# ----- Wish Cruds -----
+
+@coalesced
+@replica_read
+@timed
+async def get_wishes_from_db(couple_id: int, limit: int = 100, after: int | None = None, sess: AsyncSession | None = None):
+    """Страница желаний пары строками без ORM-объектов"""
+    async with _session(sess) as sess:
+        query = select(*WISH_COLUMNS)\
+            .filter_by(couple_id=couple_id)\
+            .order_by(Wish.id)\
+            .limit(limit + 1)
+        if after is not None:
+            query = query.where(Wish.id > after)
+        result = await sess.execute(query)
+        return _page(result.all(), limit)
+
+@coalesced
+@replica_read
+@timed
+async def get_wish_from_db(wish_id: int, sess: AsyncSession | None = None) -> Wish:
+    async with _session(sess) as sess:
+        wish = await sess.get(Wish, wish_id)
+        if wish:
+            return wish
+        raise NoWishFoundError()
+
+def _search_match(q: str):
+    """Условие совпадения и ранг для поиска по названию"""
+    if SQLITE:
+        # Запасной путь без индексов: все слова запроса входят в название, целая фраза выше
+        name = func.casefold(Wish.name, type_=String)
+        q = q.casefold()
+        matched = and_(*(name.contains(word, autoescape=True) for word in q.split()))
+        return matched, case((name.contains(q, autoescape=True), 1.0), else_=0.5)
+    # Полнотекстовое совпадение по ix_wishes_name_fts или похожее слово по ix_wishes_name_trgm —
+    # последнее находит опечатки и части слов, которых нет в словаре
+    document = search_document(Wish.name)
+    query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+    matched = or_(document.bool_op("@@")(query), literal(q, String).bool_op("<%")(Wish.name))
+    return matched, func.ts_rank_cd(document, query) + func.word_similarity(q, Wish.name)
+
+@coalesced
+@replica_read
+@timed
+async def search_wishes_in_db(q: str, couple_id: int | None = None, limit: int = 100, offset: int = 0, sess: AsyncSession | None = None):
+    """Желания, подходящие под запрос, по убыванию релевантности: пары или, без couple_id, все.
+
+    Ранжируются первые SEARCH_CANDIDATES совпадений; для списка одной пары это обычно все.
+    """
+    async with _session(sess) as sess:
+        if not SQLITE:
+            # Общий план подготовленного запроса не знает, частое ли слово, и для одной пары
+            # пересекает индекс couple_id со всеми совпадениями во всей таблице
+            await sess.execute(text("SET LOCAL plan_cache_mode = force_custom_plan"))
+        matched, rank = _search_match(q)
+        # Ранг считается при том же проходе по строкам, что и отбор кандидатов
+        candidates = select(*WISH_COLUMNS, rank.label("rank")).where(matched).limit(SEARCH_CANDIDATES)
+        if couple_id is not None:
+            candidates = candidates.where(Wish.couple_id == couple_id)
+        candidates = candidates.subquery()
+        query = select(candidates)\
+            .order_by(candidates.c.rank.desc(), candidates.c.id)\
+            .offset(offset)\
+            .limit(limit + 1)
+        rows = (await sess.execute(query)).all()
+        if len(rows) > limit:
+            return rows[:limit], offset + limit
+        return rows, None
+
+@timed
+async def add_wishes_to_db(couple_id: int, wishes: list[dict], sess: AsyncSession | None = None) -> list[Wish]:
+    async with _session(sess) as sess:
+        if not await sess.get(Couple, couple_id):
+            raise NoCoupleFoundError(couple_id)
+
+        rows = [{**wish, "couple_id": couple_id} for wish in wishes]
+        try:
+            # executemany с RETURNING SQLAlchemy сворачивает в один
+            # INSERT ... VALUES (...), (...) на каждую пачку строк
+            result = await sess.scalars(insert(Wish).returning(Wish, sort_by_parameter_order=True), rows)
+            new_wishes = result.all()
+            await _add_to_summaries(sess, rows)
+            names_by_author: dict[int, list[str]] = {}
+            for row in rows:
+                names_by_author.setdefault(row["user_added_id"], []).append(row["name"])
+            for author_id, names in names_by_author.items():
+                notify_partners(sess, couple_id, author_id, "wishes_added", {
+                    "user_id": author_id, "count": len(names), "names": names[:PREVIEW_NAMES],
+                })
+            invalidate_couples(sess, couple_id)
+            await sess.commit()
+            return new_wishes
+        except Exception as e:
+            await sess.rollback()
+            raise WishCreationError() from e
+
+@timed
+async def add_wish_to_db(couple_id: int, name: str, price: float, article: int, url: str, user_added_id: int, sess: AsyncSession | None = None) -> Wish:
+    wishes = await add_wishes_to_db(couple_id, [
+        {"name": name, "price": price, "article": article, "url": url, "user_added_id": user_added_id}
+    ], sess)
+    return wishes[0]
+
+@timed
+async def update_wish_in_db(wish_id: int, name: str = None, price: float = None, article: int = None, url: str = None, sess: AsyncSession | None = None):
+    async with _session(sess) as sess:
+        if SQLITE:
+            await _begin_immediate(sess)
+        # Старая цена вычитается из сводки, поэтому строку желания никто не должен менять до коммита
+        wish = await sess.get(Wish, wish_id, with_for_update=True)
+        if not wish:
+            raise NoWishFoundError()
+        old_price = wish.price
+        repriced = price is not None and price != old_price
+        if repriced:
+            await _lock_summary(sess, wish.couple_id, wish.user_added_id)
+        wish.name = name if name is not None else wish.name
+        wish.price = price if price is not None else wish.price
+        wish.article = article if article is not None else wish.article
+        wish.url = url if url is not None else wish.url
+        wish.version = Wish.version + 1
+        invalidate_couples(sess, wish.couple_id)
+        try:
+            if repriced:
+                await _reprice_in_summary(sess, wish.couple_id, wish.user_added_id, old_price, price)
+            await sess.commit()
+        except:
+            await sess.rollback()
+            raise WishUpdateError()
+
+@timed
+async def delete_wish_from_db(wish_id: int, sess: AsyncSession | None = None):
+    async with _session(sess) as sess:
+        if SQLITE:
+            await _begin_immediate(sess)
+        wish = await sess.get(Wish, wish_id, with_for_update=True)
+        if not wish:
+            raise NoWishFoundError()
+        await _lock_summary(sess, wish.couple_id, wish.user_added_id)
+        await sess.delete(wish)
+        invalidate_couples(sess, wish.couple_id)
+        notify_partners(sess, wish.couple_id, wish.user_added_id, "wish_deleted", {"user_id": wish.user_added_id, "name": wish.name})
+        try:
+            await _remove_from_summary(sess, wish.couple_id, wish.user_added_id, wish.price)
+            await sess.commit()
+        except:
+            await sess.rollback()
+            raise WishDeleteError()
+
+# ----- Export -----
+# Выгрузка живёт дольше обработчика запроса, поэтому держит собственную сессию
+
+async def stream_users_from_db():
+    """Отдаёт всех пользователей пачками через серверный курсор"""
+    async with session() as sess:
+        query = select(User.id, User.username, User.couple_id)\
+            .order_by(User.id)\
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        result = await sess.stream(query)
+        async for batch in result.mappings().partitions():
+            yield batch
+
+async def stream_wishes_from_db():
+    """Отдаёт все желания пачками через серверный курсор"""
+    async with session() as sess:
+        query = select(
+            Wish.id, Wish.name, Wish.price, Wish.article, Wish.url, Wish.couple_id, Wish.user_added_id
+        ).order_by(Wish.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        result = await sess.stream(query)
+        async for batch in result.mappings().partitions():
+            yield batch
+
+async def stream_couples_from_db():
+    """Отдаёт все пары вместе с пользователями и желаниями пачками через серверный курсор"""
+    async with session() as sess:
+        # selectinload выполняется отдельно для каждой пачки из yield_per,
+        # поэтому в памяти одновременно держится только одна пачка пар
+        query = select(Couple)\
+            .options(selectinload(Couple.users), selectinload(Couple.wishes))\
+            .order_by(Couple.id)\
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        result = await sess.stream_scalars(query)
+        async for batch in result.partitions():
+            yield batch
@@ -1,10 +1,250 @@
+import asyncio
+import functools
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from database.config import settings
 
-engine = create_async_engine(
-    url=settings.DATABASE_URL,
-    echo=True
-)
+logger = logging.getLogger(__name__)
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который считает, сколько запросы ждали свободное соединение"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+
+def _engine_options() -> dict:
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+    if settings.DB_BACKEND == "postgresql":
+        options["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+        return options
+    options["connect_args"] = {"timeout": settings.DB_SQLITE_BUSY_TIMEOUT}
+    if settings.SQLITE_IN_MEMORY:
+        # Каждое соединение к :memory: видит свою пустую базу, поэтому соединение одно
+        # и не пересоздаётся; сессии ждут его по очереди, как транзакции записи в SQLite
+        options.update(pool_size=1, max_overflow=0, pool_recycle=-1)
+    return options
+
+
+engine = create_async_engine(url=settings.DATABASE_URL, echo=settings.DB_ECHO, **_engine_options())
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL: читатели не блокируют писателя; для :memory: режим останется memory
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # Внешние ключи в SQLite по умолчанию не проверяются, а Postgres их проверяет
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+        # Встроенный lower() в SQLite не знает кириллицу; casefold нужен поиску желаний
+        dbapi_connection.create_function("casefold", 1, str.casefold, deterministic=True)
+
+# Отставание реплики в секундах; 0, если она применила всё полученное или это не реплика
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.engine = create_async_engine(url, echo=settings.DB_ECHO, **_engine_options())
+        # До первой проверки реплика не используется
+        self.healthy = False
+        self.lag: float | None = None
+        self.failures = 0
+
+    async def check(self):
+        try:
+            async with asyncio.timeout(settings.DB_REPLICA_CHECK_TIMEOUT):
+                async with self.engine.connect() as conn:
+                    self.lag = float(await conn.scalar(LAG_QUERY) or 0)
+        except (OSError, SQLAlchemyError, TimeoutError) as e:
+            if self.healthy:
+                logger.warning("Replica %s is unavailable: %s", self.engine.url, e)
+            self.healthy = False
+            self.lag = None
+            self.failures += 1
+            return
+        healthy = self.lag <= settings.DB_REPLICA_MAX_LAG
+        if self.healthy and not healthy:
+            logger.warning("Replica %s lags %.1f s behind, reads go elsewhere", self.engine.url, self.lag)
+        self.healthy = healthy
+
+
+class ReplicaSet:
+    """Реплики для чтения: выбор по кругу среди здоровых и фоновая проверка доступности и отставания"""
+
+    def __init__(self, urls: list[str]):
+        self.replicas = [Replica(url) for url in urls]
+        self._counter = itertools.count()
+        # Ключ клиента -> момент, до которого он читает с основной базы
+        self._sticky: dict[str, float] = {}
+        self._task: asyncio.Task | None = None
+
+    def pick(self) -> Replica | None:
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def stick(self, key: str):
+        self._sticky[key] = time.monotonic() + settings.DB_REPLICA_STICKY_SECONDS
+
+    def is_sticky(self, key: str) -> bool:
+        deadline = self._sticky.get(key)
+        return deadline is not None and deadline > time.monotonic()
+
+    async def check(self):
+        await asyncio.gather(*(replica.check() for replica in self.replicas))
+        now = time.monotonic()
+        self._sticky = {key: deadline for key, deadline in self._sticky.items() if deadline > now}
+
+    async def start(self):
+        if not self.replicas:
+            return
+        await self.check()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.DB_REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "url": replica.engine.url.render_as_string(hide_password=True),
+                "healthy": replica.healthy,
+                "lag": replica.lag,
+                "failures": replica.failures,
+                "pool": _pool_stats(replica.engine.pool),
+            }
+            for replica in self.replicas
+        ]
+
+
+# У SQLite реплик нет
+replicas = ReplicaSet(settings.REPLICA_URLS if settings.DB_BACKEND == "postgresql" else [])
+
+# Ключ клиента (Telegram id или адрес), которого после записи держим на основной базе
+client_key: ContextVar[str | None] = ContextVar("client_key", default=None)
+_replica_read: ContextVar[bool] = ContextVar("replica_read", default=False)
+
+
+def replica_read(func):
+    """Помечает функцию crud только для чтения: её запросы можно отправить на реплику"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _replica_read.set(True)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _replica_read.reset(token)
+    return wrapper
+
+def use_primary(sess: Session | None = None) -> bool:
+    """Читать с основной базы: реплик нет, в этой сессии уже писали или клиент писал недавно"""
+    if not replicas.replicas:
+        return True
+    if sess is not None and (sess.info.get("primary") or sess.info.get("pinned")):
+        return True
+    key = client_key.get()
+    return key is not None and replicas.is_sticky(key)
+
+def pin_primary(sess: Session):
+    """Дальше эта сессия читает с основной базы; в отличие от записи, клиент после неё не «прилипает»"""
+    sess.info["pinned"] = True
+
+
+class RoutingSession(Session):
+    """Запросы из функций @replica_read идут на реплику, всё остальное — на основную базу"""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if not _replica_read.get():
+            # Запись или чтение без пометки: дальше эта сессия читает только с основной базы
+            self.info["primary"] = True
+        elif not use_primary(self):
+            # Одна реплика на сессию, чтобы запросы одного чтения не попали на реплики с разным отставанием
+            replica = self.info.get("replica") or replicas.pick()
+            if replica is not None:
+                self.info["replica"] = replica
+                return replica.engine.sync_engine
+        return engine.sync_engine
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _stick_to_primary(sess):
+    key = client_key.get()
+    if replicas.replicas and key is not None and sess.info.get("primary"):
+        replicas.stick(key)
+
+
+session = async_sessionmaker(engine, sync_session_class=RoutingSession, expire_on_commit=False)
+
+
+def _pool_stats(pool) -> dict:
+    return {
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        # QueuePool ведёт overflow от -pool_size, отрицательные значения — ещё не открытые соединения
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": pool.checkouts,
+        "wait_time": pool.wait_time,
+        "max_wait": pool.max_wait,
+    }
+
+def pool_status() -> dict:
+    return _pool_stats(engine.pool)
+
 
-session = async_sessionmaker(engine, expire_on_commit=False)
+async def get_session():
+    """Одна сессия на запрос: вложенные вызовы crud делят соединение и транзакцию"""
+    async with session() as sess:
+        yield sess
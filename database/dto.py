@@ -1,18 +1,17 @@
 from pydantic import BaseModel, Field, field_validator
-from typing import Optional, List
+from typing import Annotated, Literal, Optional, List, Union
 from datetime import datetime
 
 # ----- Wish модели -----
 class WishBase(BaseModel):
-    id: int = Field(..., example=1)
     name: str = Field(..., min_length=1, max_length=255, description="Название товара", example="Новый iPhone")
     price: float = Field(..., ge=0, description="Цена товара", example=999.99)
 
 class WishCreate(WishBase):
-    couple_id: int = Field(None, description="ID пары, для которой создается желание")
-    article: int = Field(None, ge=0, description="Артикул товара")
-    url: str = Field(None, min_length=0, description="Ссылка на товар")
-    user_added_id: int = Field(None, description="ID пользователя, добавившего желание")
+    couple_id: Optional[int] = Field(None, description="ID пары, для которой создается желание")
+    article: int = Field(..., ge=0, description="Артикул товара")
+    url: str = Field(..., min_length=0, description="Ссылка на товар")
+    user_added_id: int = Field(..., description="ID пользователя, добавившего желание")
 
 class WishUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=1, max_length=255)
@@ -27,6 +26,7 @@ class WishUpdate(BaseModel):
         return v
 
 class Wish(WishBase):
+    id: int = Field(..., example=1)
     article: int
     url: str
     couple_id: int
@@ -35,6 +35,19 @@ class Wish(WishBase):
     class Config:
         from_attributes = True
 
+class WishesPage(BaseModel):
+    """Страница списка желаний пары"""
+    items: List[Wish] = []
+    next_cursor: Optional[int] = Field(None, description="Значение after для следующей страницы, null если страниц больше нет")
+
+class WishSearchHit(Wish):
+    rank: float = Field(..., description="Релевантность: чем больше, тем выше в выдаче")
+
+class WishSearchPage(BaseModel):
+    """Страница результатов поиска желаний по убыванию релевантности"""
+    items: List[WishSearchHit] = []
+    next_offset: Optional[int] = Field(None, description="Значение offset для следующей страницы, null если страниц больше нет")
+
 # ----- User модели -----
 class UserBase(BaseModel):
     id: int = Field(..., example=1)
@@ -43,6 +56,15 @@ class UserCreate(UserBase):
     username: Optional[str] = Field(None, min_length=3, max_length=50, example="test")
     couple_id: Optional[int] = Field(None, description="ID пары, к которой присоединить пользователя")
 
+class UserUpsert(UserBase):
+    """Пользователь в пачке POST /users/bulk: без couple_id пара существующего пользователя не меняется"""
+    username: str = Field(..., min_length=3, max_length=50, example="test")
+    couple_id: Optional[int] = Field(None, description="ID пары, к которой присоединить пользователя")
+
+class UsersBulkResult(BaseModel):
+    created: List[int] = Field([], description="ID созданных пользователей")
+    existing: List[int] = Field([], description="ID пользователей, которые уже существовали")
+
 class UserUpdate(BaseModel):
     username: Optional[str] = Field(None, min_length=3, max_length=50)
     couple_id: Optional[int] = Field(None, description="ID пары для присоединения, 0 для выхода из пары")
@@ -63,6 +85,11 @@ class Users(UserBase):
     class Config:
         from_attributes = True
 
+class UsersPage(BaseModel):
+    """Страница списка пользователей"""
+    items: List[Users] = []
+    next_cursor: Optional[int] = Field(None, description="Значение after для следующей страницы, null если страниц больше нет")
+
 class User(Users):
     
     message: Optional[str] = "success"
@@ -88,6 +115,11 @@ class Couple(CoupleBase):
 class CoupleWithUsers(Couple):
     users: List[UserInCouple] = []
 
+class CouplesPage(BaseModel):
+    """Страница списка пар"""
+    items: List[CoupleWithUsers] = []
+    next_cursor: Optional[int] = Field(None, description="Значение after для следующей страницы, null если страниц больше нет")
+
 class CoupleWithWishes(Couple):
     wishes: List[Wish] = []
 
@@ -96,6 +128,27 @@ class CoupleDetail(Couple):
     users: List[UserInCouple] = []
     wishes: List[Wish] = []
 
+class CoupleExport(Couple):
+    """Пара в выгрузке: id участников и все желания"""
+    user_ids: List[int] = []
+    wishes: List[Wish] = []
+
+class WishStats(BaseModel):
+    """Количество и цены желаний"""
+    count: int = 0
+    total: float = 0
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    avg_price: Optional[float] = None
+
+class UserWishStats(WishStats):
+    user_id: int = Field(..., description="ID пользователя, добавившего желания")
+
+class CoupleSummary(WishStats):
+    """Сводка по желаниям пары и по каждому её автору"""
+    id: int
+    users: List[UserWishStats] = []
+
 class CoupleUpdate(BaseModel):
     user1_id: Optional[int] = Field(None, description="ID первого пользователя")
     user2_id: Optional[int] = Field(None, description="ID второго пользователя")
@@ -105,4 +158,29 @@ class MessageResponse(BaseModel):
     message: str
 
 class UserWithCouple(User):
-    couple: Optional[Couple] = None
\ No newline at end of file
+    couple: Optional[Couple] = None
+
+# ----- Import модели -----
+# Колонки id и article в базе integer: значение больше сорвало бы вставку всей пачки
+ImportInt = Annotated[int, Field(ge=0, le=2**31 - 1)]
+
+class ImportCouple(BaseModel):
+    type: Literal["couple"]
+    id: ImportInt
+
+class ImportUser(BaseModel):
+    type: Literal["user"]
+    id: ImportInt
+    username: str = Field(..., min_length=3, max_length=50)
+    couple_id: Optional[ImportInt] = None
+
+class ImportWish(WishBase):
+    type: Literal["wish"]
+    id: Optional[ImportInt] = Field(None, description="Без id желание получит новый")
+    article: ImportInt
+    url: str
+    couple_id: ImportInt
+    user_added_id: ImportInt
+
+# Строка файла импорта: вид записи определяется полем type
+ImportRecord = Annotated[Union[ImportCouple, ImportUser, ImportWish], Field(discriminator="type")]
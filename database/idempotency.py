@@ -0,0 +1,126 @@
+"""Сохранённые ответы для заголовка Idempotency-Key.
+
+Ответ живёт в таблице idempotency_keys IDEMPOTENCY_TTL секунд, а недавние — ещё и
+в LRU-кэше воркера, поэтому повтор не доходит ни до crud, ни до базы. Строка без
+статуса означает, что первый запрос ещё выполняется: повторы из этого воркера
+присоединяются к нему через SingleFlight, из других — ждут, пока появится ответ.
+
+Ответ сохраняется отдельной транзакцией после транзакции запроса: если воркер
+упадёт между ними, ключ освободится через IDEMPOTENCY_LOCK_TIMEOUT, и повтор
+выполнится заново.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import NamedTuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database.cache import LRUCache
+from database.config import settings
+from database.db import engine, session
+from database.models import IdempotencyKey, utcnow
+from database.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+insert = sqlite.insert if engine.dialect.name == "sqlite" else postgresql.insert
+
+# Сколько просроченных ключей удалять одной транзакцией
+PURGE_BATCH_SIZE = 1000
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: bytes
+    status: int
+    # [[имя, значение], ...] в latin-1, как в ASGI
+    headers: list
+    body: bytes
+
+
+# Ответы по ключу. Из кэша ответ отдаётся не дольше IDEMPOTENCY_CACHE_TTL после строки таблицы
+responses = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_CACHE_TTL)
+# Своя SingleFlight без эпох коммитов: к выполняющемуся запросу можно присоединиться всегда
+flights = SingleFlight()
+
+
+async def claim_key(key: bytes, fingerprint: bytes) -> IdempotencyKey | None:
+    """Занимает ключ; None — ключ наш, иначе строка первого запроса.
+
+    Просроченная строка и строка, чей запрос не закончился за IDEMPOTENCY_LOCK_TIMEOUT,
+    удаляются, и ключ занимается заново.
+    """
+    ttl = timedelta(seconds=settings.IDEMPOTENCY_TTL)
+    lock_timeout = timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT)
+    async with session() as sess:
+        while True:
+            now = utcnow()
+            claimed = await sess.scalar(
+                insert(IdempotencyKey)
+                .values(key=key, fingerprint=fingerprint, created_at=now, expires_at=now + ttl)
+                .on_conflict_do_nothing(index_elements=[IdempotencyKey.key])
+                .returning(IdempotencyKey.key)
+            )
+            if claimed is not None:
+                await sess.commit()
+                return None
+            row = await sess.get(IdempotencyKey, key, populate_existing=True)
+            if row is None:
+                # Строку удалили между запросами
+                continue
+            if row.expires_at > now and (row.status is not None or row.created_at > now - lock_timeout):
+                await sess.commit()
+                return row
+            # created_at в условии: строку, занятую заново другим воркером, не трогаем
+            await sess.execute(
+                delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.created_at == row.created_at)
+            )
+            await sess.commit()
+
+async def save_response(key: bytes, response: StoredResponse):
+    async with session() as sess:
+        await sess.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key)
+            .values(status=response.status, headers=response.headers, body=response.body)
+        )
+        await sess.commit()
+    responses.set(key, response, responses.epoch)
+
+async def release_key(key: bytes):
+    """Освобождает ключ запроса, который не дал ответа: повтор выполнится заново"""
+    async with session() as sess:
+        await sess.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status.is_(None)))
+        await sess.commit()
+
+def stored_response(row: IdempotencyKey) -> StoredResponse:
+    response = StoredResponse(row.fingerprint, row.status, row.headers, row.body)
+    responses.set(row.key, response, responses.epoch)
+    return response
+
+
+async def purge_expired_keys() -> int:
+    """Удаляет просроченные ключи пачками, возвращает сколько удалено"""
+    purged = 0
+    while True:
+        async with session() as sess:
+            expired = select(IdempotencyKey.key)\
+                .where(IdempotencyKey.expires_at <= utcnow())\
+                .limit(PURGE_BATCH_SIZE)\
+                .scalar_subquery()
+            result = await sess.execute(delete(IdempotencyKey).where(IdempotencyKey.key.in_(expired)))
+            await sess.commit()
+        purged += result.rowcount
+        if result.rowcount < PURGE_BATCH_SIZE:
+            return purged
+
+async def purge_forever(interval: float):
+    while True:
+        try:
+            purged = await purge_expired_keys()
+            if purged:
+                logger.info("Purged %d expired idempotency keys", purged)
+        except Exception:
+            logger.exception("Idempotency keys purge failed")
+        await asyncio.sleep(interval)
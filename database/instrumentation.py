@@ -0,0 +1,72 @@
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from database.config import settings
+from database.db import engine, replicas
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """Число запросов к БД и суммарное время их выполнения в рамках одного запроса к API"""
+    __slots__ = ("count", "duration", "shapes")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        return [(shape, count) for shape, count in self.shapes.items() if count > threshold]
+
+
+current_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+# Списки плейсхолдеров ($1, $2::INTEGER, ...) схлопываются, чтобы IN (...) разной длины
+# считались одним и тем же запросом
+_PLACEHOLDERS = re.compile(r"(\$\d+|\?)(::\w+)?(\s*,\s*(\$\d+|\?)(::\w+)?)*")
+
+
+def statement_shape(statement: str) -> str:
+    return _PLACEHOLDERS.sub("?", " ".join(statement.split()))
+
+def redact(parameters) -> str:
+    """Оставляет от параметров только структуру, без значений"""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: ?" for key in parameters) + "}"
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"<{len(parameters)} rows of {redact(parameters[0])}>"
+        return "(" + ", ".join("?" for _ in parameters) + ")"
+    return "?"
+
+
+# Начало запроса хранится в контексте выполнения, а не в соединении: after_cursor_execute
+# не вызывается для упавшего запроса, и стек в conn.info копил бы лишние отметки
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "query_start", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats = current_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += elapsed
+        if settings.SQL_DEBUG:
+            stats.shapes[statement_shape(statement)] += 1
+    if elapsed * 1000 >= settings.SQL_SLOW_QUERY_MS:
+        logger.warning("Slow query (%.1f ms): %s; parameters: %s", elapsed * 1000, " ".join(statement.split()), redact(parameters))
+
+
+for _engine in (engine, *(replica.engine for replica in replicas.replicas)):
+    event.listen(_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+import asyncpg
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from database.cache import ALL, couple_cache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+# Полезная нагрузка NOTIFY ограничена 8000 байт
+MAX_PAYLOAD = 7900
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+
+def encode_keys(couple_ids) -> str:
+    if ALL in couple_ids:
+        return "*"
+    payload = ",".join(f"couple:{couple_id}" for couple_id in sorted(couple_ids))
+    return payload if len(payload) <= MAX_PAYLOAD else "*"
+
+def apply_payload(payload: str):
+    """Вытесняет из локальных кэшей ключи, пришедшие от других воркеров"""
+    if payload == "*":
+        couple_cache.clear()
+        return
+    couple_ids = []
+    for key in payload.split(","):
+        kind, _, entity_id = key.partition(":")
+        if kind == "couple" and entity_id.isdigit():
+            couple_ids.append(int(entity_id))
+    couple_cache.invalidate(*couple_ids)
+
+
+@event.listens_for(Session, "before_commit")
+def _publish_before_commit(sess):
+    # NOTIFY внутри транзакции доставляется только после успешного коммита
+    changed = sess.info.get("changed_couples")
+    if not changed or sess.get_bind().dialect.name != "postgresql":
+        return
+    sess.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": encode_keys(changed)})
+
+
+class InvalidationListener:
+    """Держит отдельное соединение с LISTEN и сбрасывает локальные кэши по уведомлениям"""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.connected = False
+        self.connects = 0
+        self.received = 0
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.received += 1
+        apply_payload(payload)
+
+    async def _run(self):
+        delay = RECONNECT_DELAY
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _, lost=lost: lost.set())
+                await conn.add_listener(CHANNEL, self._on_notify)
+                # Пока соединения не было, уведомления могли потеряться
+                couple_cache.clear()
+                self.connected = True
+                self.connects += 1
+                delay = RECONNECT_DELAY
+                await lost.wait()
+                logger.warning("Invalidation listener connection lost")
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning("Invalidation listener failed to connect: %s", e)
+            finally:
+                if self.connected:
+                    couple_cache.clear()
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def stats(self) -> dict:
+        return {"connected": self.connected, "connects": self.connects, "received": self.received}
@@ -0,0 +1,116 @@
+import ast
+import asyncio
+import logging
+from pathlib import Path
+
+from sqlalchemy import inspect, text
+
+from database.config import settings
+from database.db import engine
+from database.models import Base
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_INI = Path(__file__).parent.parent / "alembic.ini"
+VERSIONS_DIR = Path(__file__).parent / "migrations" / "versions"
+# Постоянный ключ pg_advisory_lock: миграции выполняет один воркер, остальные ждут
+MIGRATION_LOCK_KEY = 0x77697368
+MIGRATION_LOCK_POLL = 0.5
+
+
+def script_heads() -> set[str]:
+    """Головные ревизии из файлов миграций.
+
+    Файлы разбираются через ast, а не импортом alembic: на быстром пути
+    старта, когда база уже на голове, alembic не нужен вовсе.
+    """
+    revisions, parents = set(), set()
+    for path in VERSIONS_DIR.glob("*.py"):
+        values = {}
+        for node in ast.parse(path.read_text(encoding="utf-8")).body:
+            if isinstance(node, ast.AnnAssign) and node.value is not None:
+                targets, value = [node.target], node.value
+            elif isinstance(node, ast.Assign):
+                targets, value = node.targets, node.value
+            else:
+                continue
+            for target in targets:
+                if isinstance(target, ast.Name) and target.id in ("revision", "down_revision"):
+                    values[target.id] = ast.literal_eval(value)
+        revisions.add(values["revision"])
+        down_revision = values.get("down_revision")
+        if isinstance(down_revision, str):
+            parents.add(down_revision)
+        elif down_revision:
+            parents.update(down_revision)
+    return revisions - parents
+
+
+async def database_heads(conn) -> set[str]:
+    if not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("alembic_version")):
+        return set()
+    return set(await conn.scalars(text("SELECT version_num FROM alembic_version")))
+
+
+def _migrate(connection, versioned: bool):
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(str(ALEMBIC_INI))
+    # env.py выполнит миграции на этом соединении, а не создаст свой движок
+    config.attributes["connection"] = connection
+    if versioned:
+        command.upgrade(config, "head")
+        return
+    if inspect(connection).get_table_names():
+        raise RuntimeError(
+            "В базе есть таблицы, но нет alembic_version: отметьте её ревизию через alembic stamp"
+        )
+    # Первая миграция пустая, поэтому новую базу создаёт create_all, а история начинается с головы
+    Base.metadata.create_all(connection)
+    connection.commit()
+    command.stamp(config, "head")
+
+
+async def ensure_schema() -> str:
+    """Проверяет, что база на головной ревизии; с DB_AUTO_MIGRATE доводит её до головы.
+
+    Возвращает, что пришлось сделать: up-to-date, migrated или created.
+    """
+    heads = script_heads()
+    async with engine.connect() as conn:
+        current = await database_heads(conn)
+    if current == heads:
+        return "up-to-date"
+    if not settings.DB_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"База на ревизии {', '.join(sorted(current)) or 'без версии'}, код ждёт "
+            f"{', '.join(sorted(heads))}: выполните alembic upgrade head"
+        )
+
+    postgres = engine.dialect.name == "postgresql"
+    # Блокировка сессионная, поэтому миграции идут на том же соединении, что её держит
+    async with engine.connect() as conn:
+        if postgres:
+            # Ждать в pg_advisory_lock нельзя: CREATE INDEX CONCURRENTLY у мигрирующего
+            # воркера ждёт снимки всех транзакций, в том числе ждущей блокировку
+            while not await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}):
+                await conn.commit()
+                await asyncio.sleep(MIGRATION_LOCK_POLL)
+            await conn.commit()
+        try:
+            # Пока ждали блокировку, другой воркер мог уже всё сделать
+            current = await database_heads(conn)
+            if current == heads:
+                return "up-to-date"
+            # autocommit_block в миграциях требует, чтобы транзакцию начинал сам alembic
+            await conn.commit()
+            logger.warning("Migrating database from %s to %s", sorted(current) or "empty", sorted(heads))
+            await conn.run_sync(_migrate, bool(current))
+            await conn.commit()
+            return "migrated" if current else "created"
+        finally:
+            if postgres:
+                await conn.rollback()
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                await conn.commit()
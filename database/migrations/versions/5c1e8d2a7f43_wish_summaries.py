@@ -0,0 +1,44 @@
+"""wish summaries
+
+Revision ID: 5c1e8d2a7f43
+Revises: ea993eb57021
+Create Date: 2026-10-17 22:05:12.481907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1e8d2a7f43'
+down_revision: Union[str, Sequence[str], None] = 'ea993eb57021'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'wish_summaries',
+        sa.Column('couple_id', sa.Integer(), nullable=False),
+        sa.Column('user_added_id', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Float(), nullable=False),
+        sa.Column('min_price', sa.Float(), nullable=False),
+        sa.Column('max_price', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['couple_id'], ['couples.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('couple_id', 'user_added_id'),
+    )
+    # Сводка по уже существующим желаниям
+    op.execute(
+        'INSERT INTO wish_summaries (couple_id, user_added_id, count, total, min_price, max_price) '
+        'SELECT couple_id, user_added_id, count(*), sum(price), min(price), max(price) '
+        'FROM wishes GROUP BY couple_id, user_added_id'
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('wish_summaries')
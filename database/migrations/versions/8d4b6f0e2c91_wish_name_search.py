@@ -0,0 +1,46 @@
+"""wish name search indexes
+
+Revision ID: 8d4b6f0e2c91
+Revises: 5c1e8d2a7f43
+Create Date: 2026-10-17 23:12:40.915362
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d4b6f0e2c91'
+down_revision: Union[str, Sequence[str], None] = '5c1e8d2a7f43'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # В SQLite поиск работает без индексов
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index(
+            'ix_wishes_name_trgm', 'wishes', ['name'],
+            postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}, postgresql_concurrently=True,
+        )
+        # Выражение должно совпадать с models.search_document
+        op.create_index(
+            'ix_wishes_name_fts', 'wishes', [sa.text("to_tsvector('russian'::regconfig, name)")],
+            postgresql_using='gin', postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # Расширение pg_trgm остаётся: его могут использовать не только эти индексы
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_wishes_name_fts', table_name='wishes', postgresql_concurrently=True)
+        op.drop_index('ix_wishes_name_trgm', table_name='wishes', postgresql_concurrently=True)
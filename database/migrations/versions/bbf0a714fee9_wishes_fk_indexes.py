@@ -0,0 +1,33 @@
+"""wishes foreign key indexes
+
+Revision ID: bbf0a714fee9
+Revises: c0360ff49226
+Create Date: 2026-10-17 18:52:10.412873
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bbf0a714fee9'
+down_revision: Union[str, Sequence[str], None] = 'c0360ff49226'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY не блокирует запись в wishes, но не работает внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_wishes_couple_id'), 'wishes', ['couple_id'], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_wishes_user_added_id'), 'wishes', ['user_added_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_wishes_user_added_id'), table_name='wishes', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_wishes_couple_id'), table_name='wishes', postgresql_concurrently=True)
@@ -0,0 +1,40 @@
+"""idempotency keys
+
+Revision ID: c81e4b7a9d26
+Revises: a3f7c2d9e514
+Create Date: 2026-10-18 14:02:51.774390
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81e4b7a9d26'
+down_revision: Union[str, Sequence[str], None] = 'a3f7c2d9e514'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'idempotency_keys',
+        sa.Column('key', sa.LargeBinary(length=32), nullable=False),
+        sa.Column('fingerprint', sa.LargeBinary(length=32), nullable=False),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('headers', sa.JSON(), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.create_index(op.f('ix_idempotency_keys_expires_at'), 'idempotency_keys', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_idempotency_keys_expires_at'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,32 @@
+"""row nonces for etags
+
+Revision ID: e4b19d7c2f60
+Revises: c81e4b7a9d26
+Create Date: 2026-10-17 23:41:08.512730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b19d7c2f60'
+down_revision: Union[str, Sequence[str], None] = 'c81e4b7a9d26'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Существующим строкам хватит 0: nonce отличает только строки, созданные после них с тем же id
+    for table in ('user', 'couples'):
+        op.add_column(table, sa.Column('nonce', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in ('couples', 'user'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('nonce')
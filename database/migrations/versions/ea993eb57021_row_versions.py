@@ -0,0 +1,37 @@
+"""row versions for etags
+
+Revision ID: ea993eb57021
+Revises: bbf0a714fee9
+Create Date: 2026-10-17 21:14:37.208391
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'ea993eb57021'
+down_revision: Union[str, Sequence[str], None] = 'bbf0a714fee9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # NOT NULL с константой по умолчанию Postgres добавляет без перезаписи таблицы
+    for table in ('user', 'couples', 'wishes'):
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    # По user.couple_id считается ETag пары
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_user_couple_id'), 'user', ['couple_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_user_couple_id'), table_name='user', postgresql_concurrently=True)
+    for table in ('wishes', 'couples', 'user'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
@@ -0,0 +1,31 @@
+"""wish summaries user index
+
+Revision ID: f1a6c3e8b027
+Revises: e4b19d7c2f60
+Create Date: 2026-10-18 10:14:37.206518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1a6c3e8b027'
+down_revision: Union[str, Sequence[str], None] = 'e4b19d7c2f60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Первичный ключ (couple_id, user_added_id) не помогает отбору по одному автору
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_wish_summaries_user_added_id'), 'wish_summaries', ['user_added_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_wish_summaries_user_added_id'), table_name='wish_summaries', postgresql_concurrently=True)
@@ -1,7 +1,29 @@
-from sqlalchemy import ForeignKey
+import secrets
+from datetime import UTC, datetime
+
+from sqlalchemy import DDL, JSON, Double, ForeignKey, Index, LargeBinary, event, func, text
 from sqlalchemy.orm import mapped_column, Mapped, relationship, DeclarativeBase
 from typing import Optional
 
+# Конфигурация полнотекстового поиска по названиям желаний; названия в основном на русском
+SEARCH_CONFIG = text("'russian'::regconfig")
+
+def utcnow() -> datetime:
+    """Время для колонок datetime: naive UTC одинаково сравнивается в Postgres и SQLite"""
+    return datetime.now(UTC).replace(tzinfo=None)
+
+def new_nonce() -> int:
+    """Случайное число экземпляра строки для ETag.
+
+    id пользователя после удаления может прийти снова, id пары в SQLite и при импорте тоже
+    достаются заново, а версия новой строки опять 1: без nonce ETag совпал бы с прежним.
+    """
+    return secrets.randbits(31)
+
+def search_document(name):
+    """tsvector названия. Запрос должен строить его так же, как индекс ix_wishes_name_fts, иначе индекс не подойдёт"""
+    return func.to_tsvector(SEARCH_CONFIG, name)
+
 class Base(DeclarativeBase):
     pass
 
@@ -9,12 +31,17 @@ class User(Base):
     __tablename__ = "user"
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str]
-    couple_id: Mapped[Optional[int]] = mapped_column(ForeignKey("couples.id"))
+    couple_id: Mapped[Optional[int]] = mapped_column(ForeignKey("couples.id"), index=True)
+    # Растёт при каждой записи в строку; из версий собираются ETag
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    nonce: Mapped[int] = mapped_column(default=new_nonce, server_default="0")
     couple: Mapped[Optional["Couple"]] = relationship(back_populates="users")
 
 class Couple(Base):
     __tablename__ = "couples"
     id: Mapped[int] = mapped_column(primary_key=True, index=True, autoincrement=True)
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    nonce: Mapped[int] = mapped_column(default=new_nonce, server_default="0")
     users: Mapped[list["User"]] = relationship(back_populates="couple", cascade="all")
     wishes: Mapped[list["Wish"]] = relationship(cascade="all, delete-orphan")
 
@@ -25,6 +52,62 @@ class Wish(Base):
     price: Mapped[float]
     article: Mapped[int]
     url: Mapped[str]
-    couple_id: Mapped[int] = mapped_column(ForeignKey("couples.id"))
-    user_added_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
-    
\ No newline at end of file
+    couple_id: Mapped[int] = mapped_column(ForeignKey("couples.id"), index=True)
+    user_added_id: Mapped[int] = mapped_column(ForeignKey("user.id"), index=True)
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+
+# Индексы поиска по названию есть только в Postgres, в SQLite поиск работает без них
+event.listen(
+    Wish.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+Index(
+    "ix_wishes_name_trgm", Wish.__table__.c.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}
+).ddl_if(dialect="postgresql")
+Index("ix_wishes_name_fts", search_document(Wish.__table__.c.name), postgresql_using="gin").ddl_if(dialect="postgresql")
+    
+class WishSummary(Base):
+    """Количество и цены желаний пары по каждому автору.
+
+    Поддерживается crud в той же транзакции, что и запись желаний;
+    расхождение исправляет python manage.py rebuild-summaries.
+    """
+    __tablename__ = "wish_summaries"
+    # Удаление пары (в том числе каскадом из запросов crud) удаляет и её сводку
+    couple_id: Mapped[int] = mapped_column(ForeignKey("couples.id", ondelete="CASCADE"), primary_key=True)
+    # Индекс для удаления строк автора: первичный ключ начинается с couple_id
+    user_added_id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    count: Mapped[int]
+    # Миграция 5c1e8d2a7f43 создала колонки как double precision
+    total: Mapped[float] = mapped_column(Double)
+    min_price: Mapped[float] = mapped_column(Double)
+    max_price: Mapped[float] = mapped_column(Double)
+
+class OutboxEvent(Base):
+    """Уведомление партнёру, записанное в той же транзакции, что и изменение.
+
+    Рассылает database.outbox.dispatcher; доставленные строки удаляются.
+    """
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # id пользователя Telegram; внешнего ключа нет, уведомление переживает удаление получателя
+    recipient_id: Mapped[int]
+    event: Mapped[str]
+    payload: Mapped[dict] = mapped_column(JSON)
+    created_at: Mapped[datetime]
+    # Раньше этого момента строку не берут: так откладываются повторные попытки
+    available_at: Mapped[datetime]
+    attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+
+class IdempotencyKey(Base):
+    """Ответ на запрос с заголовком Idempotency-Key, который получат повторы запроса"""
+    __tablename__ = "idempotency_keys"
+    # sha256 от клиента и присланного ключа: длина строки не зависит от клиента
+    key: Mapped[bytes] = mapped_column(LargeBinary(32), primary_key=True)
+    # sha256 метода, пути и тела: тот же ключ с другим запросом — ошибка клиента
+    fingerprint: Mapped[bytes] = mapped_column(LargeBinary(32))
+    # NULL, пока первый запрос выполняется
+    status: Mapped[Optional[int]]
+    headers: Mapped[Optional[list]] = mapped_column(JSON)
+    body: Mapped[Optional[bytes]] = mapped_column(LargeBinary)
+    created_at: Mapped[datetime]
+    expires_at: Mapped[datetime] = mapped_column(index=True)
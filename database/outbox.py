@@ -0,0 +1,261 @@
+"""Уведомления партнёрам через transactional outbox.
+
+Функции crud только записывают событие в сессию, а строки таблицы outbox
+вставляются при коммите той же транзакции: запись не ждёт Telegram, и
+уведомление не теряется, если процесс упадёт после коммита. Фоновый
+dispatcher забирает строки пачками (FOR UPDATE SKIP LOCKED, поэтому его
+можно запускать в каждом воркере), склеивает события одного получателя
+в одно сообщение и отдаёт его отправителю. Доставка — at-least-once:
+падение между отправкой и отметкой о ней приведёт к повтору.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy import JSON, String, delete, event, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from database.config import settings
+from database.db import session
+from database.models import OutboxEvent, User, utcnow
+
+logger = logging.getLogger(__name__)
+
+# Сколько названий желаний хранить в событии и показывать в сообщении
+PREVIEW_NAMES = 5
+
+# Получает id получателя и его события по порядку, при ошибке бросает исключение
+Sender = Callable[[int, list[dict]], Awaitable[None]]
+
+
+def notify_partners(sess, couple_id: int | None, actor_id: int, kind: str, payload: dict):
+    """Уведомить при коммите остальных участников пары о действии actor_id.
+
+    Получатели выбираются в момент коммита: кто успел выйти из пары, уведомление не получит.
+    """
+    if couple_id:
+        sess.info.setdefault("outbox", []).append((couple_id, actor_id, kind, payload))
+
+
+@event.listens_for(Session, "before_commit")
+def _write_outbox(sess):
+    events = sess.info.get("outbox")
+    if not events:
+        return
+    now = utcnow()
+    for couple_id, actor_id, kind, payload in events:
+        recipients = select(
+            User.id, literal(kind, String), literal(payload, JSON), literal(now), literal(now)
+        ).where(User.couple_id == couple_id, User.id != actor_id)
+        sess.execute(insert(OutboxEvent).from_select(
+            ["recipient_id", "event", "payload", "created_at", "available_at"], recipients
+        ))
+
+@event.listens_for(Session, "after_commit")
+def _wake_dispatcher(sess):
+    if sess.info.pop("outbox", None):
+        dispatcher.wake()
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_outbox(sess, previous_transaction):
+    sess.info.pop("outbox", None)
+
+
+def render_message(events: list[dict]) -> str:
+    """Одно сообщение из всех событий получателя"""
+    added, added_count, deleted, left = [], 0, [], False
+    for item in events:
+        payload = item["payload"]
+        if item["event"] == "wishes_added":
+            added.extend(payload["names"])
+            added_count += payload["count"]
+        elif item["event"] == "wish_deleted":
+            deleted.append(payload["name"])
+        elif item["event"] == "partner_left":
+            left = True
+    lines = []
+    if added_count:
+        more = added_count - len(added[:PREVIEW_NAMES])
+        lines.append(f"Партнёр добавил желания: {', '.join(added[:PREVIEW_NAMES])}" + (f" и ещё {more}" if more else ""))
+    if deleted:
+        more = len(deleted) - PREVIEW_NAMES
+        lines.append(f"Партнёр удалил желания: {', '.join(deleted[:PREVIEW_NAMES])}" + (f" и ещё {more}" if more > 0 else ""))
+    if left:
+        lines.append("Партнёр вышел из пары")
+    return "\n".join(lines)
+
+
+class LoggingSender:
+    """Отправитель-заглушка: пишет сообщения в лог и хранит последние для тестов"""
+
+    def __init__(self, keep: int = 1000):
+        self.sent: deque[tuple[int, str]] = deque(maxlen=keep)
+
+    async def __call__(self, recipient_id: int, events: list[dict]):
+        text = render_message(events)
+        self.sent.append((recipient_id, text))
+        logger.info("Notification to %s: %s", recipient_id, text)
+
+
+class OutboxDispatcher:
+    """Фоновая рассылка строк outbox.
+
+    Пачка забирается короткой транзакцией: под FOR UPDATE SKIP LOCKED строкам
+    прибавляется попытка, а available_at сдвигается на OUTBOX_LEASE, и другие воркеры
+    их не берут. Отправка идёт без транзакции и соединения из пула; затем вторая короткая
+    транзакция удаляет доставленные строки, а недоставленные откладывает с растущей
+    задержкой. После OUTBOX_MAX_ATTEMPTS попыток строки пишутся в лог и удаляются.
+    """
+
+    def __init__(self, sender: Sender, batch_size: int, interval: float, linger: float = 0.0):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.interval = interval
+        self.linger = linger
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.claimed = 0
+        self.messages = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Строки прерванной пачки отправит следующий запуск, когда истечёт их аренда
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wake = None
+
+    def wake(self):
+        """Коммит в этом процессе записал уведомления: не ждать очередного опроса"""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                claimed = await self.dispatch()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                claimed = 0
+            # Полная пачка — вероятно, есть ещё строки, забираем сразу
+            if claimed < self.batch_size:
+                try:
+                    async with asyncio.timeout(self.interval):
+                        await self._wake.wait()
+                except TimeoutError:
+                    continue
+                # Разбудил коммит: даём серии действий партнёра дописаться, чтобы уйти одним сообщением
+                await asyncio.sleep(self.linger)
+
+    async def dispatch(self) -> int:
+        """Забирает и рассылает одну пачку, возвращает число взятых строк"""
+        rows = await self._claim()
+        if not rows:
+            return 0
+        self.claimed += len(rows)
+
+        # Строки отсортированы по id, поэтому события получателя идут в порядке записи
+        by_recipient: dict[int, list[OutboxEvent]] = {}
+        for row in rows:
+            by_recipient.setdefault(row.recipient_id, []).append(row)
+        results = await asyncio.gather(
+            *(self._send(recipient_id, group) for recipient_id, group in by_recipient.items())
+        )
+
+        done, retry = [], []
+        for group, sent in zip(by_recipient.values(), results):
+            for row in group:
+                if sent:
+                    done.append(row.id)
+                elif row.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    logger.error("Dropping outbox event %s (%s) to %s after %d attempts: %s",
+                                 row.id, row.event, row.recipient_id, row.attempts, row.payload)
+                    self.dropped += 1
+                    done.append(row.id)
+                else:
+                    retry.append(row)
+        await self._settle(done, retry)
+        return len(rows)
+
+    async def _claim(self) -> list[OutboxEvent]:
+        """Берёт пачку в аренду на OUTBOX_LEASE и сразу коммитит"""
+        async with session() as sess:
+            now = utcnow()
+            available = select(OutboxEvent.id)\
+                .where(OutboxEvent.available_at <= now)\
+                .order_by(OutboxEvent.id)\
+                .limit(self.batch_size)\
+                .with_for_update(skip_locked=True)
+            rows = (await sess.scalars(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_(available))
+                .values(
+                    attempts=OutboxEvent.attempts + 1,
+                    available_at=now + timedelta(seconds=settings.OUTBOX_LEASE),
+                )
+                .returning(OutboxEvent),
+                execution_options={"synchronize_session": False},
+            )).all()
+            await sess.commit()
+        # RETURNING не обещает порядок строк
+        return sorted(rows, key=lambda row: row.id)
+
+    async def _settle(self, done: list[int], retry: list[OutboxEvent]):
+        """Удаляет доставленные строки и откладывает остальные до следующей попытки"""
+        async with session() as sess:
+            now = utcnow()
+            if done:
+                await sess.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(done)))
+            for row in retry:
+                delay = min(settings.OUTBOX_RETRY_DELAY * 2 ** (row.attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
+                # Если аренда истекла и строку взял другой воркер, её попытки уже не наши
+                await sess.execute(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id == row.id, OutboxEvent.attempts == row.attempts)
+                    .values(available_at=now + timedelta(seconds=delay))
+                )
+            await sess.commit()
+
+    async def _send(self, recipient_id: int, rows: list[OutboxEvent]) -> bool:
+        events = [{"id": row.id, "event": row.event, "payload": row.payload, "created_at": row.created_at} for row in rows]
+        try:
+            await self.sender(recipient_id, events)
+        except Exception:
+            self.failed += 1
+            logger.exception("Notification to %s failed", recipient_id)
+            return False
+        self.messages += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "claimed": self.claimed,
+            "messages": self.messages,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+async def outbox_backlog() -> dict:
+    """Сколько уведомлений ждёт отправки и возраст самого старого"""
+    async with session() as sess:
+        pending, oldest = (await sess.execute(select(func.count(), func.min(OutboxEvent.created_at)))).one()
+    return {"pending": pending, "oldest_seconds": (utcnow() - oldest).total_seconds() if oldest else None}
+
+
+dispatcher = OutboxDispatcher(
+    LoggingSender(), settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_POLL_INTERVAL, settings.OUTBOX_LINGER
+)
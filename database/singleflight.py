@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import inspect
+
+from sqlalchemy import event
+from sqlalchemy import inspect as inspect_orm
+from sqlalchemy.orm import Session
+
+from database.db import use_primary
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые чтения в один запрос к БД.
+
+    Первый вызов с ключом выполняет запрос, остальные ждут его результат или исключение.
+    К запросу можно присоединиться, только пока не было коммитов: иначе вызов, начатый
+    после записи, получил бы данные, прочитанные до неё.
+    """
+
+    def __init__(self):
+        # key -> (epoch, future)
+        self._calls: dict = {}
+        self.epoch = 0
+        # name -> [выполнено запросов, присоединившихся вызовов]
+        self._stats: dict[str, list[int]] = {}
+
+    async def do(self, name: str, key, call):
+        counters = self._stats.setdefault(name, [0, 0])
+        while True:
+            flight = self._calls.get(key)
+            if flight is None or flight[0] != self.epoch:
+                break
+            future = flight[1]
+            counters[1] += 1
+            try:
+                # shield: отмена одного из ждущих не отменяет запрос для остальных
+                return detached_copy(await asyncio.shield(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # Отменили запрос того, кто его начал — пробуем снова сами
+
+        future = asyncio.get_running_loop().create_future()
+        flight = self._calls[key] = (self.epoch, future)
+        counters[0] += 1
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение полученным, даже если никто не ждал
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._calls.get(key) is flight:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        return {
+            name: {"executed": executed, "coalesced": coalesced}
+            # Копия: сбор метрик идёт из пула потоков, пока цикл событий дописывает функции
+            for name, (executed, coalesced) in list(self._stats.items())
+        }
+
+
+flights = SingleFlight()
+
+
+def detached_copy(result):
+    """Копия результата для присоединившегося вызова.
+
+    ORM-объекты копируются без привязки к сессии: объекты первого вызова принадлежат
+    его сессии, и чужой запрос не должен ни подгружать через неё, ни менять их.
+    """
+    if isinstance(result, list):
+        return [detached_copy(item) for item in result]
+    if type(result) is tuple:
+        return tuple(detached_copy(item) for item in result)
+    if isinstance(result, dict):
+        return {key: detached_copy(value) for key, value in result.items()}
+    if inspect_orm(result, raiseerr=False) is None:
+        # Строки Row и скаляры неизменяемы
+        return result
+    # merge без загрузки копирует загруженные атрибуты и связи, не обращаясь к БД
+    with Session() as copier:
+        copy = copier.merge(result, load=False)
+        copier.expunge_all()
+    return copy
+
+
+def has_writes(sess: Session) -> bool:
+    """В транзакции сессии есть изменения, которых ещё не видят другие"""
+    return bool(sess.new or sess.dirty or sess.deleted or sess.info.get("writes"))
+
+
+@event.listens_for(Session, "after_flush")
+def _flushed(sess, flush_context):
+    sess.info["writes"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _executed(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info["writes"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _new_epoch(sess):
+    flights.epoch += 1
+    sess.info.pop("writes", None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _rolled_back(sess):
+    sess.info.pop("writes", None)
+
+
+def coalesced(func):
+    """Объединяет одновременные вызовы функции чтения crud с одинаковыми аргументами.
+
+    Сессия в ключ не входит: запрос выполняется в сессии первого вызова,
+    остальные получают копию его результата. Входит то, откуда читать: тот, кто
+    только что писал, не должен получить данные чужого чтения с реплики.
+    Сессия с незакоммиченными изменениями читает сама и не делится результатом:
+    он видит её запись, которой для других ещё нет.
+    """
+    name = func.__name__
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        sess = bound.arguments.pop("sess", None)
+        if sess is not None and has_writes(sess.sync_session):
+            return await func(*args, **kwargs)
+        key = (name, use_primary(sess.sync_session if sess is not None else None), *bound.arguments.values())
+        return await flights.do(name, key, lambda: func(*args, **kwargs))
+    return wrapper
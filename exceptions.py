@@ -25,6 +25,10 @@ class UserUpdateError(CoupleWishesException):
 class UserDeleteError(CoupleWishesException):
     def __str__(self):
         return "Ошибка удаления пользователя"
+
+class UserHasWishesError(UserDeleteError):
+    def __str__(self):
+        return "У пользователя остались желания в паре с партнёром: удалите их или передайте purge_wishes=true"
     
 # ----- Couple Exception -----
 class NoCoupleFoundError(CoupleWishesException):
@@ -50,4 +54,41 @@ class WishCreationError(CoupleWishesException):
 
 class NoWishFoundError(CoupleWishesException):
     def __str__(self):
-        return "Желание не найдено"
\ No newline at end of file
+        return "Желание не найдено"
+
+class WishUpdateError(CoupleWishesException):
+    def __str__(self):
+        return "Ошибка обновления желания"
+
+class WishDeleteError(CoupleWishesException):
+    def __str__(self):
+        return "Ошибка удаления желания"
+
+# ----- Request Exception -----
+class TooManyRequestsError(CoupleWishesException):
+    def __str__(self):
+        return "Слишком много запросов, попробуйте позже"
+
+class IdempotencyKeyInProgressError(CoupleWishesException):
+    def __str__(self):
+        return "Запрос с этим Idempotency-Key ещё выполняется"
+
+class IdempotencyKeyReusedError(CoupleWishesException):
+    def __str__(self):
+        return "Idempotency-Key уже использован для другого запроса"
+
+class IdempotencyKeyNotSupportedError(CoupleWishesException):
+    def __str__(self):
+        return "Idempotency-Key не поддерживается этим маршрутом"
+
+class PayloadTooLargeError(CoupleWishesException):
+    def __str__(self):
+        return "Слишком большое тело запроса"
+
+class InternalAccessDeniedError(CoupleWishesException):
+    def __str__(self):
+        return "Служебный маршрут: нужен X-Internal-Token"
+
+class ImportNotSupportedError(CoupleWishesException):
+    def __str__(self):
+        return "Импорт недоступен на SQLite в памяти: он занял бы единственное соединение с базой"
@@ -1,25 +1,192 @@
+import time
+
+# Отсчёт старта с первой строки: в отчёт попадает и время импортов
+STARTED = time.perf_counter()
+
+import asyncio
+import hmac
+import io
+import logging
+import tempfile
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from typing import Annotated, List, Literal, Optional
+
+import orjson
+from fastapi import Body, Depends, FastAPI, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from fastapi import status
 
-from database.db import engine
-from database.models import Base
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.config import settings
+from database.db import engine, get_session, pin_primary, pool_status, replicas, use_primary
+from database.cache import couple_cache
+from database.invalidation import InvalidationListener
+from database import idempotency
+from database.bulk_import import file_lines, import_wishlists
+from database.migrate import ensure_schema
+from database.outbox import dispatcher, outbox_backlog
+from database.singleflight import flights
+
+from database.crud import (
+    SEARCH_CANDIDATES,
+    add_user_to_db,
+    add_wish_to_db,
+    add_wishes_to_db,
+    create_couple,
+    delete_couple_from_db,
+    delete_user_from_db,
+    delete_wish_from_db,
+    get_all_couples_from_db,
+    get_all_users_from_db,
+    get_couple_detail_from_db,
+    get_couple_etag_from_db,
+    get_couple_summary_from_db,
+    get_user_from_db,
+    get_wish_from_db,
+    get_wishes_from_db,
+    search_wishes_in_db,
+    stream_couples_from_db,
+    stream_users_from_db,
+    stream_wishes_from_db,
+    update_couple_in_db,
+    update_user_in_db,
+    update_wish_in_db,
+    upsert_users_to_db,
+)
+from database.dto import (
+    CoupleCreate,
+    CoupleDetail,
+    CoupleExport,
+    CoupleUpdate,
+    CouplesPage,
+    CoupleSummary,
+    User,
+    UserCreate,
+    UserUpdate,
+    UserUpsert,
+    Users,
+    UsersBulkResult,
+    UsersPage,
+    Wish,
+    WishCreate,
+    WishSearchPage,
+    WishUpdate,
+    WishesPage,
+)
 
-from database.crud import *
-from database.dto import *
+from exceptions import (
+    CoupleCreationError,
+    CoupleUpdateError,
+    CoupleWishesException,
+    ImportNotSupportedError,
+    InternalAccessDeniedError,
+    NoCoupleFoundError,
+    NoUserFoundError,
+    NoWishFoundError,
+    UserAlreadyExistsError,
+    UserCreationError,
+    UserDeleteError,
+    UserHasWishesError,
+    UserUpdateError,
+    WishCreationError,
+    WishDeleteError,
+    WishUpdateError,
+)
+from middleware import (
+    ClientKeyMiddleware,
+    IdempotencyMiddleware,
+    MetricsMiddleware,
+    QueryStatsMiddleware,
+    RateLimitMiddleware,
+)
+from metrics import (
+    record_error,
+    record_startup,
+    register_outbox,
+    register_pool,
+    register_rate_limits,
+    register_routes,
+    register_singleflight,
+    register_update_queue,
+)
+from ratelimit import limiter
+from webhook import updates
+
+logger = logging.getLogger(__name__)
+
+IMPORTED = time.perf_counter()
 
-from exceptions import *
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as connection:
-        await connection.run_sync(Base.metadata.create_all)
+    phases = {"imports": IMPORTED - STARTED}
+    mark = time.perf_counter()
+
+    def phase(name: str):
+        nonlocal mark
+        now = time.perf_counter()
+        phases[name] = now - mark
+        mark = now
+
+    app.state.schema = await ensure_schema()
+    phase("schema")
+    # Сбрасывает кэш этого воркера, когда другие воркеры меняют данные.
+    # У SQLite нет LISTEN/NOTIFY: с ней запускается один воркер
+    app.state.invalidation_listener = None
+    if engine.dialect.name == "postgresql":
+        app.state.invalidation_listener = InvalidationListener(
+            engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        )
+        await app.state.invalidation_listener.start()
+    phase("listener")
+    await replicas.start()
+    phase("replicas")
+    updates.start()
+    if settings.OUTBOX_ENABLED:
+        dispatcher.start()
+    idempotency_purge = asyncio.create_task(idempotency.purge_forever(settings.IDEMPOTENCY_PURGE_INTERVAL))
+    register_routes(app.routes)
+    limiter.configure(app.routes, settings.RATE_LIMITS, settings.RATE_LIMIT_SHARDS)
+    phase("routes")
+    app.state.startup = record_startup(phases)
+    logger.info(
+        "Started in %.3fs (schema %s): %s",
+        sum(phases.values()),
+        app.state.schema,
+        ", ".join(f"{name} {seconds:.3f}s" for name, seconds in phases.items()),
+    )
     yield
+    # Сначала воркеры дорабатывают принятые обновления: им ещё нужны база и реплики
+    await updates.stop(settings.TELEGRAM_DRAIN_TIMEOUT)
+    await dispatcher.stop()
+    idempotency_purge.cancel()
+    await replicas.stop()
+    if app.state.invalidation_listener:
+        await app.state.invalidation_listener.stop()
+
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BULK_SIZE = 10000
+MAX_QUERY_LENGTH = 200
+
+SearchQuery = Annotated[str, Query(min_length=2, max_length=MAX_QUERY_LENGTH, description="Слова из названия, допускаются опечатки")]
+SearchOffset = Annotated[int, Query(ge=0, lt=SEARCH_CANDIDATES, description="Сколько результатов пропустить")]
 
 app = FastAPI(lifespan=lifespan)
 
+# Повтор запроса получает сохранённый ответ, не доходя до crud; лимит проверяется раньше.
+# Импорт читает тело потоком, и буферизовать его ради ключа нельзя
+app.add_middleware(IdempotencyMiddleware, unbuffered=frozenset({"POST /internal/import"}))
+# Внутри метрик, чтобы 429 попадали в них, и до любого обработчика с сессией БД
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(ClientKeyMiddleware)
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,96 +195,399 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+register_pool(pool_status)
+register_singleflight(flights.stats)
+register_update_queue(updates.stats)
+register_outbox(dispatcher.stats)
+register_rate_limits(limiter.stats)
+
+
+def json_response(content) -> Response:
+    """Готовый JSON из строк БД: FastAPI не валидирует его по response_model повторно,
+    а схема OpenAPI по-прежнему берётся из response_model маршрута"""
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
+def page_response(items, next_cursor: int | None) -> Response:
+    return json_response({
+        "items": [item if isinstance(item, dict) else item._asdict() for item in items],
+        "next_cursor": next_cursor,
+    })
+
+def search_response(rows, next_offset: int | None) -> Response:
+    return json_response({"items": [row._asdict() for row in rows], "next_offset": next_offset})
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Сравнение для If-None-Match: слабое, как требует RFC 9110, и с поддержкой *"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+def error_response(status_code: int, e: CoupleWishesException) -> HTMLResponse:
+    """Ответ с текстом исключения; класс исключения попадает в метки метрик"""
+    record_error(e)
+    return HTMLResponse(status_code=status_code, content=str(e))
+
+def require_internal_token(x_internal_token: Optional[str] = Header(None)):
+    """Пускает на служебные маршруты только с settings.INTERNAL_TOKEN; без настройки — никого"""
+    token = settings.INTERNAL_TOKEN
+    if not token or not hmac.compare_digest((x_internal_token or "").encode(), token.encode()):
+        raise InternalAccessDeniedError()
+
+@app.exception_handler(InternalAccessDeniedError)
+async def internal_access_denied(request: Request, e: InternalAccessDeniedError):
+    return error_response(status.HTTP_403_FORBIDDEN, e)
+
+# Зависимость всех маршрутов /internal/*
+INTERNAL = [Depends(require_internal_token)]
+
+
+#=========TELEGRAM=========#
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    """Принимает обновление и сразу отвечает: обработка идёт в воркерах webhook.updates"""
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    if secret and not hmac.compare_digest((x_telegram_bot_api_secret_token or "").encode(), secret.encode()):
+        return Response(status_code=status.HTTP_403_FORBIDDEN)
+    try:
+        update = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    if not isinstance(update, dict) or "update_id" not in update:
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    if not updates.submit(update):
+        # Telegram доставит обновление повторно позже
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+    return Response()
+
+
 #=========USERS=========#
-@app.get("/users/", response_model=List[Users])
-async def get_users():
-    users = await get_all_users_from_db()
-    return users
+@app.get("/users/", response_model=UsersPage)
+async def get_users(
+    sess: SessionDep,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = Query(None, description="Курсор: id последнего пользователя предыдущей страницы"),
+):
+    users, next_cursor = await get_all_users_from_db(limit, after, sess)
+    return page_response(users, next_cursor)
 
 @app.get("/users/{user_id}/", response_model=User)
-async def get_user_by_id(user_id: int):
+async def get_user_by_id(
+    user_id: int,
+    sess: SessionDep,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
     try:
-        user = await get_user_from_db(user_id)
+        user = await get_user_from_db(user_id, sess)
+        etag = f'"{user.nonce}.{user.version}"'
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
         return user
     except NoUserFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
 
-@app.post("/users/")
-async def add_user(user: UserCreate):
+@app.post("/users/", response_model=Users)
+async def add_user(user: UserCreate, sess: SessionDep):
     try:
-        new_user = await add_user_to_db(user.id, user.username)
+        new_user = await add_user_to_db(user.id, user.username, None, sess)
         return new_user
     except UserAlreadyExistsError as e:
-        return HTMLResponse(status_code=status.HTTP_409_CONFLICT, content=str(e))
+        return error_response(status.HTTP_409_CONFLICT, e)
     except UserCreationError as e:
-        return HTMLResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=str(e))
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+@app.post("/users/bulk", response_model=UsersBulkResult)
+async def add_users_bulk(
+    sess: SessionDep,
+    users: List[UserUpsert] = Body(..., max_length=MAX_BULK_SIZE),
+    overwrite: bool = Query(False, description="Обновить username и переданный couple_id у уже существующих пользователей"),
+):
+    try:
+        created, existing = await upsert_users_to_db([user.model_dump(exclude_unset=True) for user in users], overwrite, sess)
+        return UsersBulkResult(created=created, existing=existing)
+    except UserCreationError as e:
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
     
 @app.put("/users/{user_id}")
-async def update_user(user_id: int, user: UserUpdate):
+async def update_user(user_id: int, user: UserUpdate, sess: SessionDep):
     try:
         if user.username:
-            await update_user_in_db(user_id, user.username, user.couple_id)
+            await update_user_in_db(user_id, user.username, user.couple_id, sess)
             return {"status": "success"}
         else:
             return {"status": "error", "message": "No username provided"}
     except NoUserFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
     except UserUpdateError as e:
-        return HTMLResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=str(e))
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
         
 @app.delete("/users/{user_id}")
-async def delete_user(user_id: int):
+async def delete_user(
+    user_id: int,
+    sess: SessionDep,
+    purge_wishes: bool = Query(False, description="Удалить и желания пользователя в парах, где остаётся партнёр"),
+):
     try:
-        await delete_user_from_db(user_id)
+        await delete_user_from_db(user_id, purge_wishes, sess)
         return {"status": "success"}
     except NoUserFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+    except UserHasWishesError as e:
+        return error_response(status.HTTP_409_CONFLICT, e)
     except UserDeleteError as e:
-        return HTMLResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=str(e))
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
 
-@app.get("/couples/", response_model=List[CoupleWithUsers])
-async def get_couples():
-    couples = await get_all_couples_from_db()
-    return couples
+@app.get("/couples/", response_model=CouplesPage)
+async def get_couples(
+    sess: SessionDep,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = Query(None, description="Курсор: id последней пары предыдущей страницы"),
+):
+    couples, next_cursor = await get_all_couples_from_db(limit, after, sess)
+    return page_response(couples, next_cursor)
     
 @app.get("/couples/{couple_id}", response_model=CoupleDetail)
-async def get_couple_by_id(couple_id: int):
+async def get_couple_by_id(couple_id: int, sess: SessionDep, if_none_match: Optional[str] = Header(None)):
     try:
-        couple = await get_couple_from_db(couple_id)
-        return couple
+        # Клиент, который недавно писал, читает мимо кэша: инвалидация от другого воркера могла ещё не дойти
+        sticky = bool(replicas.replicas) and use_primary(sess.sync_session)
+        cached = None if sticky else couple_cache.get(couple_id)
+        if cached is not None:
+            etag, payload = cached
+        else:
+            epoch = couple_cache.epoch
+            # То, что попадёт в кэш, читается с основной базы: отстающая реплика вернула бы
+            # пару до инвалидации, и та прожила бы в кэше весь COUPLE_CACHE_TTL
+            pin_primary(sess.sync_session)
+            # ETag считается до чтения пары: запись между запросами даст лишний 200, но не устаревший 304
+            etag = await get_couple_etag_from_db(couple_id, sess)
+            if etag is None:
+                raise NoCoupleFoundError(couple_id)
+            payload = None
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        if payload is None:
+            payload = orjson.dumps(await get_couple_detail_from_db(couple_id, sess))
+            couple_cache.set(couple_id, (etag, payload), epoch)
+        return Response(content=payload, media_type="application/json", headers={"ETag": etag})
     except NoCoupleFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
         
 
 @app.post("/couples/")
-async def add_couple(couple: CoupleCreate):
+async def add_couple(couple: CoupleCreate, sess: SessionDep):
     try:
-        await create_couple(couple.user1_id, couple.user2_id)
+        await create_couple(couple.user1_id, couple.user2_id, sess)
         return couple
     except NoUserFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
     except CoupleCreationError as e:
-        return HTMLResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=str(e))
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
 
 @app.put("/couples/{couple_id}")
-async def update_couple(couple_id: int, couple: CoupleUpdate):
+async def update_couple(couple_id: int, couple: CoupleUpdate, sess: SessionDep):
     try:
         if couple.user1_id:
-            await update_couple_in_db(couple_id, couple.user1_id, couple.user2_id)
+            await update_couple_in_db(couple_id, couple.user1_id, couple.user2_id, sess)
             return {"status": "success"}
         else:
             return HTMLResponse(status_code=status.HTTP_400_BAD_REQUEST, content="Не передано user1_id")
     except NoCoupleFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
     except NoUserFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
     except CoupleUpdateError as e:
-        return HTMLResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=str(e))
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
 
 @app.delete("/couples/{couple_id}")
-async def delete_couple(couple_id: int):
+async def delete_couple(couple_id: int, sess: SessionDep):
     try:
-        await delete_couple_from_db(couple_id)
+        await delete_couple_from_db(couple_id, sess)
         return {"status": "success"}
     except NoCoupleFoundError as e:
-        return HTMLResponse(status_code=status.HTTP_404_NOT_FOUND, content=str(e))
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+
+
+@app.get("/couples/{couple_id}/wishes", response_model=WishesPage)
+async def get_couple_wishes(
+    couple_id: int,
+    sess: SessionDep,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = Query(None, description="Курсор: id последнего желания предыдущей страницы"),
+):
+    wishes, next_cursor = await get_wishes_from_db(couple_id, limit, after, sess)
+    return page_response(wishes, next_cursor)
+
+@app.get("/couples/{couple_id}/summary", response_model=CoupleSummary)
+async def get_couple_summary(couple_id: int, sess: SessionDep):
+    try:
+        return json_response(await get_couple_summary_from_db(couple_id, sess))
+    except NoCoupleFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+
+@app.get("/couples/{couple_id}/wishes/search", response_model=WishSearchPage)
+async def search_couple_wishes(
+    couple_id: int,
+    q: SearchQuery,
+    sess: SessionDep,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: SearchOffset = 0,
+):
+    rows, next_offset = await search_wishes_in_db(q, couple_id, limit, offset, sess)
+    return search_response(rows, next_offset)
+
+@app.post("/couples/{couple_id}/wishes", response_model=List[Wish])
+async def add_couple_wishes(
+    couple_id: int,
+    sess: SessionDep,
+    wishes: List[WishCreate] = Body(..., max_length=MAX_BULK_SIZE),
+):
+    try:
+        return await add_wishes_to_db(couple_id, [wish.model_dump(exclude={"couple_id"}) for wish in wishes], sess)
+    except NoCoupleFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+    except WishCreationError as e:
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+@app.get("/wishes/{wish_id}", response_model=Wish)
+async def get_wish_by_id(wish_id: int, sess: SessionDep):
+    try:
+        return await get_wish_from_db(wish_id, sess)
+    except NoWishFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+
+@app.post("/wishes/", response_model=Wish)
+async def add_wish(wish: WishCreate, sess: SessionDep):
+    try:
+        if wish.couple_id:
+            return await add_wish_to_db(
+                wish.couple_id, wish.name, wish.price, wish.article, wish.url, wish.user_added_id, sess
+            )
+        else:
+            return HTMLResponse(status_code=status.HTTP_400_BAD_REQUEST, content="Не передано couple_id")
+    except NoCoupleFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+    except WishCreationError as e:
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+@app.put("/wishes/{wish_id}")
+async def update_wish(wish_id: int, wish: WishUpdate, sess: SessionDep):
+    try:
+        await update_wish_in_db(wish_id, wish.name, wish.price, wish.article, wish.url, sess)
+        return {"status": "success"}
+    except NoWishFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+    except WishUpdateError as e:
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+@app.delete("/wishes/{wish_id}")
+async def delete_wish(wish_id: int, sess: SessionDep):
+    try:
+        await delete_wish_from_db(wish_id, sess)
+        return {"status": "success"}
+    except NoWishFoundError as e:
+        return error_response(status.HTTP_404_NOT_FOUND, e)
+    except WishDeleteError as e:
+        return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, e)
+
+
+@app.get("/internal/cache", dependencies=INTERNAL)
+async def get_cache_stats():
+    listener = app.state.invalidation_listener
+    return {
+        "couples": couple_cache.stats(),
+        "listener": listener.stats() if listener else None,
+        "singleflight": flights.stats(),
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    # Обычная функция: FastAPI выполнит сбор метрик в пуле потоков, не останавливая цикл событий
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/internal/pool", dependencies=INTERNAL)
+async def get_pool_stats():
+    return {**pool_status(), "replicas": replicas.stats()}
+
+@app.get("/internal/wishes/search", response_model=WishSearchPage, dependencies=INTERNAL)
+async def search_all_wishes(
+    q: SearchQuery,
+    sess: SessionDep,
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset: SearchOffset = 0,
+):
+    """Поиск по желаниям всех пар для администраторов"""
+    rows, next_offset = await search_wishes_in_db(q, None, limit, offset, sess)
+    return search_response(rows, next_offset)
+
+@app.get("/internal/telegram", dependencies=INTERNAL)
+async def get_telegram_stats():
+    return updates.stats()
+
+@app.get("/internal/outbox", dependencies=INTERNAL)
+async def get_outbox_stats():
+    return {**dispatcher.stats(), **await outbox_backlog()}
+
+@app.get("/internal/ratelimit", dependencies=INTERNAL)
+async def get_rate_limit_stats():
+    return limiter.stats()
+
+@app.get("/internal/idempotency", dependencies=INTERNAL)
+async def get_idempotency_stats():
+    return {"cache": idempotency.responses.stats(), "flights": idempotency.flights.stats()}
+
+@app.get("/internal/startup", dependencies=INTERNAL)
+async def get_startup_stats():
+    return {"schema": app.state.schema, "phases": app.state.startup}
+
+def ndjson_response(batches, encode) -> StreamingResponse:
+    """Построчно сериализует пачки из серверного курсора в NDJSON"""
+    async def body():
+        async for batch in batches:
+            yield b"".join(encode(item) + b"\n" for item in batch)
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def encode_row(row) -> bytes:
+    return orjson.dumps(dict(row))
+
+def encode_couple(couple) -> bytes:
+    return CoupleExport(
+        id=couple.id,
+        user_ids=[user.id for user in couple.users],
+        wishes=couple.wishes,
+    ).model_dump_json().encode()
+
+@app.post("/internal/import", dependencies=INTERNAL)
+async def import_file(request: Request, format: Literal["ndjson", "csv"] = Query("ndjson")):
+    """Импорт пар, пользователей и желаний из тела запроса; в ответе NDJSON с прогрессом и ошибками строк"""
+    if settings.SQLITE_IN_MEMORY:
+        return error_response(status.HTTP_501_NOT_IMPLEMENTED, ImportNotSupportedError())
+    # Тело сначала сохраняется на диск: читать его, пока идёт потоковый ответ, ASGI-серверы не обязаны позволять
+    upload = tempfile.TemporaryFile()
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+
+    async def events():
+        with io.TextIOWrapper(upload, encoding="utf-8-sig", newline="") as file:
+            async for event in import_wishlists(file_lines(file), format):
+                yield [event]
+    return ndjson_response(events(), orjson.dumps)
+
+@app.get("/export/users.ndjson")
+async def export_users():
+    return ndjson_response(stream_users_from_db(), encode_row)
+
+@app.get("/export/couples.ndjson")
+async def export_couples():
+    return ndjson_response(stream_couples_from_db(), encode_couple)
+
+@app.get("/export/wishes.ndjson")
+async def export_wishes():
+    return ndjson_response(stream_wishes_from_db(), encode_row)
@@ -0,0 +1,65 @@
+"""Служебные команды для работы с базой без запуска приложения.
+
+    python manage.py rebuild-summaries              # пересчитать сводки желаний всех пар
+    python manage.py rebuild-summaries --couple 42  # только одной пары
+    python manage.py import-wishlists data.csv --errors errors.ndjson  # импорт из CSV или NDJSON
+"""
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+from database.db import engine
+
+
+async def rebuild_summaries(args) -> dict:
+    from database.crud import rebuild_wish_summaries
+
+    return await rebuild_wish_summaries(args.couple)
+
+
+async def import_wishlists(args) -> dict:
+    from database.bulk_import import file_lines, import_wishlists
+
+    fmt = args.format or ("csv" if args.file.suffix == ".csv" else "ndjson")
+    errors = args.errors.open("w", encoding="utf-8") if args.errors else sys.stderr
+    try:
+        with args.file.open(encoding="utf-8-sig", newline="") as file:
+            async for event in import_wishlists(file_lines(file), fmt):
+                if "error" in event:
+                    print(json.dumps(event, ensure_ascii=False), file=errors)
+                elif event["stage"] == "done":
+                    return event
+                else:
+                    print(f"{event['stage']}: {event['rows']}", file=sys.stderr)
+    finally:
+        if args.errors:
+            errors.close()
+
+
+async def run(args) -> dict:
+    try:
+        return await args.command(args)
+    finally:
+        await engine.dispose()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(required=True)
+
+    rebuild = commands.add_parser("rebuild-summaries", help="пересчитать сводки желаний из самих желаний")
+    rebuild.add_argument("--couple", type=int, help="id пары, по умолчанию все")
+    rebuild.set_defaults(command=rebuild_summaries)
+
+    load = commands.add_parser("import-wishlists", help="импортировать пары, пользователей и желания из файла")
+    load.add_argument("file", type=Path, help="CSV или NDJSON, в каждой строке поле type: couple, user или wish")
+    load.add_argument("--format", choices=("csv", "ndjson"), help="по умолчанию по расширению файла")
+    load.add_argument("--errors", type=Path, help="куда писать отклонённые строки, по умолчанию в stderr")
+    load.set_defaults(command=import_wishlists)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(run(parse_args())), ensure_ascii=False))
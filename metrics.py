@@ -0,0 +1,202 @@
+import functools
+import time
+from contextvars import ContextVar
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ["route", "method", "status"]
+)
+REQUEST_ERRORS = Counter(
+    "http_request_errors_total", "Ответы с ошибкой по коду и исключению", ["route", "method", "status", "error"]
+)
+CRUD_LATENCY = Histogram("crud_duration_seconds", "Время выполнения функций crud", ["function"])
+CRUD_ERRORS = Counter("crud_errors_total", "Исключения из функций crud", ["function", "error"])
+TELEGRAM_WAIT = Histogram("telegram_update_wait_seconds", "Сколько обновление Telegram ждало воркера")
+TELEGRAM_DURATION = Histogram("telegram_update_duration_seconds", "Время обработки обновления Telegram", ["kind"])
+STARTUP_SECONDS = Gauge("app_startup_seconds", "Длительность этапов запуска воркера", ["phase"])
+
+# Код, для которого дочерние метрики создаются заранее; остальные появляются при первом ответе
+KNOWN_STATUS = 200
+
+# (route, method, status) -> histogram, (route, method, status, error) -> counter.
+# Вызов .labels() ищет дочернюю метрику под блокировкой, поэтому на горячем пути
+# используется обычный словарь
+_latency: dict = {}
+_errors: dict = {}
+
+
+class RequestMetrics:
+    """Исключение, которое обработчик превратил в ответ с ошибкой"""
+    __slots__ = ("error",)
+
+    def __init__(self):
+        self.error = None
+
+
+current_request: ContextVar[RequestMetrics | None] = ContextVar("request_metrics", default=None)
+
+
+def record_error(exc: Exception):
+    metrics = current_request.get()
+    if metrics is not None:
+        metrics.error = type(exc).__name__
+
+def record_startup(phases: dict[str, float]) -> dict[str, float]:
+    for phase, seconds in phases.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    return phases
+
+def register_routes(routes):
+    """Заранее создаёт дочерние метрики успешных ответов для всех маршрутов приложения.
+
+    Гистограммы остальных кодов и счётчики ошибок заводятся при первом таком ответе:
+    каждая гистограмма — десяток рядов, и все сочетания маршрута, метода и кода
+    раздували бы выдачу /metrics до сотен килобайт.
+    """
+    for route in routes:
+        # Служебные маршруты документации (/docs, /openapi.json) не нужны
+        if not getattr(route, "include_in_schema", False):
+            continue
+        for method in route.methods:
+            _latency[(route.path, method, KNOWN_STATUS)] = REQUEST_LATENCY.labels(route.path, method, str(KNOWN_STATUS))
+
+def observe_request(route: str, method: str, status: int, error: str | None, elapsed: float):
+    key = (route, method, status)
+    histogram = _latency.get(key)
+    if histogram is None:
+        histogram = _latency[key] = REQUEST_LATENCY.labels(route, method, str(status))
+    histogram.observe(elapsed)
+    if status >= 400:
+        key += (error or "none",)
+        counter = _errors.get(key)
+        if counter is None:
+            counter = _errors[key] = REQUEST_ERRORS.labels(route, method, str(status), error or "none")
+        counter.inc()
+
+
+def timed(func):
+    """Замеряет время выполнения и считает исключения корутины из crud"""
+    name = func.__name__
+    histogram = CRUD_LATENCY.labels(name)
+    errors: dict = {}
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            counter = errors.get(error)
+            if counter is None:
+                counter = errors[error] = CRUD_ERRORS.labels(name, error)
+            counter.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+class PoolCollector:
+    """Отдаёт состояние пула соединений в момент сбора метрик"""
+
+    def __init__(self, status):
+        self.status = status
+
+    def collect(self):
+        status = self.status()
+        for name in ("size", "max_overflow", "checked_out", "idle", "overflow"):
+            yield GaugeMetricFamily(f"db_pool_{name}", f"Пул соединений: {name}", value=status[name])
+        yield CounterMetricFamily("db_pool_checkouts", "Выдано соединений из пула", value=status["checkouts"])
+        yield CounterMetricFamily("db_pool_wait_seconds", "Суммарное ожидание соединения", value=status["wait_time"])
+        yield GaugeMetricFamily("db_pool_max_wait_seconds", "Самое долгое ожидание соединения", value=status["max_wait"])
+
+
+def register_pool(status):
+    REGISTRY.register(PoolCollector(status))
+
+
+class SingleFlightCollector:
+    """Сколько чтений crud выполнено и сколько присоединилось к уже идущим"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        executed = CounterMetricFamily("crud_singleflight_executed", "Выполнено чтений crud", labels=["function"])
+        coalesced = CounterMetricFamily(
+            "crud_singleflight_coalesced", "Вызовы crud, получившие результат чужого запроса", labels=["function"]
+        )
+        for name, counters in self.stats().items():
+            executed.add_metric([name], counters["executed"])
+            coalesced.add_metric([name], counters["coalesced"])
+        yield executed
+        yield coalesced
+
+
+def register_singleflight(stats):
+    REGISTRY.register(SingleFlightCollector(stats))
+
+
+class UpdateQueueCollector:
+    """Заполненность очереди обновлений Telegram и судьба принятых обновлений"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        stats = self.stats()
+        yield GaugeMetricFamily("telegram_queue_depth", "Обновления в очереди и в обработке", value=stats["depth"])
+        yield GaugeMetricFamily("telegram_queue_capacity", "Размер очереди обновлений", value=stats["capacity"])
+        yield GaugeMetricFamily("telegram_queue_chats", "Чаты с необработанными обновлениями", value=stats["chats"])
+        yield GaugeMetricFamily("telegram_workers_busy", "Воркеры, занятые обновлением", value=stats["busy"])
+        updates = CounterMetricFamily("telegram_updates", "Обновления Telegram по результату", labels=["result"])
+        for result in ("accepted", "rejected", "processed", "failed"):
+            updates.add_metric([result], stats[result])
+        yield updates
+
+
+def register_update_queue(stats):
+    REGISTRY.register(UpdateQueueCollector(stats))
+
+
+class OutboxCollector:
+    """Рассылка уведомлений из outbox в этом воркере"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        stats = self.stats()
+        yield CounterMetricFamily("outbox_events_claimed", "Строки outbox, взятые на отправку", value=stats["claimed"])
+        yield CounterMetricFamily("outbox_events_dropped", "События, отброшенные после всех попыток", value=stats["dropped"])
+        messages = CounterMetricFamily("outbox_messages", "Сообщения получателям по результату", labels=["result"])
+        messages.add_metric(["sent"], stats["messages"])
+        messages.add_metric(["failed"], stats["failed"])
+        yield messages
+
+
+def register_outbox(stats):
+    REGISTRY.register(OutboxCollector(stats))
+
+
+class RateLimitCollector:
+    """Корзины токенов и отказы по ограниченным маршрутам"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        buckets = GaugeMetricFamily("rate_limit_buckets", "Корзины токенов в памяти воркера", labels=["route"])
+        rejected = CounterMetricFamily("rate_limit_rejected", "Запросы, отклонённые с 429", labels=["route"])
+        for route, stats in self.stats().items():
+            buckets.add_metric([route], stats["buckets"])
+            rejected.add_metric([route], stats["rejected"])
+        yield buckets
+        yield rejected
+
+
+def register_rate_limits(stats):
+    REGISTRY.register(RateLimitCollector(stats))
@@ -0,0 +1,315 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from functools import lru_cache
+from ipaddress import ip_address, ip_network
+
+from starlette.routing import Match
+
+from database.config import settings
+from database.db import client_key
+from database.instrumentation import QueryStats, current_stats
+from database import idempotency
+from exceptions import (
+    IdempotencyKeyInProgressError,
+    IdempotencyKeyNotSupportedError,
+    IdempotencyKeyReusedError,
+    PayloadTooLargeError,
+    TooManyRequestsError,
+)
+from metrics import RequestMetrics, current_request, observe_request, record_error
+from ratelimit import limiter
+
+logger = logging.getLogger(__name__)
+
+MUTATING_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+# Как часто повтор проверяет, не закончил ли первый запрос в другом воркере
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+# Ответ для повтора, не дождавшегося первого запроса
+IN_PROGRESS = object()
+TRUSTED_NETWORKS = tuple(ip_network(address, strict=False) for address in settings.TRUSTED_PROXIES)
+
+
+class QueryStatsMiddleware:
+    """Считает запросы к БД на каждый HTTP-запрос и отдаёт их в заголовке Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = current_stats.set(stats)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timing = f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"'
+                message["headers"] = [*message.get("headers", []), (b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_stats.reset(token)
+            if settings.SQL_DEBUG:
+                for shape, count in stats.repeated(settings.SQL_REPEAT_THRESHOLD):
+                    logger.warning(
+                        "Possible N+1: %s %s ran the same statement %d times: %s",
+                        scope["method"], scope["path"], count, shape,
+                    )
+
+
+class MetricsMiddleware:
+    """Гистограмма времени ответа и счётчик ошибок по шаблону маршрута"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        request_metrics = RequestMetrics()
+        token = current_request.set(request_metrics)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as e:
+            status = 500
+            request_metrics.error = type(e).__name__
+            raise
+        finally:
+            current_request.reset(token)
+            # Шаблон пути вместо самого пути, чтобы id не плодили ряды метрик
+            route = scope.get("route")
+            observe_request(
+                route.path if route else "unmatched",
+                scope["method"],
+                status,
+                request_metrics.error,
+                time.perf_counter() - start,
+            )
+
+
+@lru_cache(maxsize=1024)
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        address = ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_NETWORKS)
+
+def telegram_user_key(scope) -> str | None:
+    """Telegram id пользователя из заголовка бота; None, если его нет или прислал не доверенный адрес.
+
+    Заголовок принимается только от адресов settings.TRUSTED_PROXIES: остальные
+    клиенты, меняя его, получали бы новую корзину лимита на каждый запрос.
+    """
+    client = scope.get("client")
+    if client and is_trusted_proxy(client[0]):
+        for name, value in scope["headers"]:
+            if name == b"x-telegram-user-id":
+                return "tg:" + value.decode("latin-1")
+    return None
+
+def request_client_key(scope) -> str | None:
+    """Telegram id пользователя, иначе адрес клиента"""
+    key = telegram_user_key(scope)
+    if key is None:
+        client = scope.get("client")
+        key = client[0] if client else None
+    return key
+
+
+async def send_error(send, status: int, error: Exception, headers=()):
+    """Ответ с текстом исключения из middleware, как error_response в main.py"""
+    record_error(error)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/html; charset=utf-8"), *headers],
+    })
+    await send({"type": "http.response.body", "body": str(error).encode()})
+
+
+class ClientKeyMiddleware:
+    """Запоминает, чей это запрос: после записи пользователь какое-то время читает с основной базы.
+
+    Без доверенного X-Telegram-User-Id ключа нет: за адресом бота стоят все его пользователи,
+    и запись одного отправляла бы на основную базу чтения остальных.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = client_key.set(telegram_user_key(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            client_key.reset(token)
+
+
+class RateLimitMiddleware:
+    """Отвечает 429 на запросы сверх лимита маршрута, пока не открыта ни одна сессия БД.
+
+    Лимит считается на пользователя Telegram; запросы без доверенного X-Telegram-User-Id
+    не ограничиваются, иначе все пользователи бота делили бы корзину его адреса.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            matched = limiter.match(scope)
+            if matched is not None:
+                route, buckets = matched
+                key = telegram_user_key(scope)
+                wait = buckets.take(key, time.monotonic()) if key is not None else 0.0
+                if wait:
+                    # Запрос не дойдёт до роутера: шаблон маршрута для метрик ставим сами
+                    scope["route"] = route
+                    return await send_error(send, 429, TooManyRequestsError(), [(b"retry-after", str(math.ceil(wait)).encode())])
+        await self.app(scope, receive, send)
+
+
+class IdempotencyMiddleware:
+    """Повтор изменяющего запроса с тем же Idempotency-Key получает сохранённый ответ первого.
+
+    Ключ действует в пределах клиента (request_client_key): без доверенного заголовка это
+    адрес, общий для всех пользователей бота, поэтому ключи должны быть уникальны. Одновременные повторы ждут
+    первый запрос, а не выполняются параллельно; ответы 5xx не сохраняются, чтобы
+    повтор мог выполниться заново. Тело запроса и ответ держатся в памяти целиком,
+    поэтому маршруты unbuffered («МЕТОД /шаблон/пути»), которые читают тело потоком,
+    ключ не принимают.
+    """
+
+    def __init__(self, app, unbuffered: frozenset[str] = frozenset()):
+        self.app = app
+        self.unbuffered = unbuffered
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            return await self.app(scope, receive, send)
+        header = next((value for name, value in scope["headers"] if name == b"idempotency-key"), None)
+        if header is None:
+            return await self.app(scope, receive, send)
+
+        # Шаблон маршрута нужен и для проверки ниже, и метрикам, если роутер не выполнится
+        route = next((route for route in scope["app"].routes if route.matches(scope)[0] == Match.FULL), None)
+        if route is not None and f"{scope['method']} {route.path}" in self.unbuffered:
+            scope["route"] = route
+            return await send_error(send, 400, IdempotencyKeyNotSupportedError())
+        try:
+            body = await read_body(receive, settings.IDEMPOTENCY_MAX_BODY_SIZE, scope["headers"])
+        except PayloadTooLargeError as e:
+            scope["route"] = route
+            return await send_error(send, 413, e)
+        if body is None:
+            return
+        client = (request_client_key(scope) or "").encode()
+        key = hashlib.sha256(client + b"\0" + header).digest()
+        fingerprint = hashlib.sha256(
+            b"\0".join((scope["method"].encode(), scope["path"].encode(), scope["query_string"], body))
+        ).digest()
+        executed = False
+
+        async def execute():
+            nonlocal executed
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+            while (row := await idempotency.claim_key(key, fingerprint)) is not None:
+                if row.fingerprint != fingerprint:
+                    return None
+                if row.status is not None:
+                    return idempotency.stored_response(row)
+                # Первый запрос выполняется в другом воркере
+                if time.monotonic() >= deadline:
+                    return IN_PROGRESS
+                await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+            executed = True
+            return await self.run(scope, body, receive, key, fingerprint)
+
+        response = idempotency.responses.get(key)
+        if response is None:
+            response = await idempotency.flights.do("idempotency", key, execute)
+        if not executed:
+            # Роутер не выполнялся: шаблон маршрута для метрик ставим сами
+            scope["route"] = route
+        if response is IN_PROGRESS:
+            return await send_error(send, 409, IdempotencyKeyInProgressError(), [(b"retry-after", b"1")])
+        if response is None or response.fingerprint != fingerprint:
+            return await send_error(send, 422, IdempotencyKeyReusedError())
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response.headers]
+        if not executed:
+            headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": response.body})
+
+    async def run(self, scope, body: bytes, receive, key: bytes, fingerprint: bytes):
+        """Выполняет запрос, собирая ответ целиком: его получат и повторы, ждущие этот запрос"""
+        status, headers, chunks = 500, [], []
+
+        async def replay_body():
+            nonlocal body
+            if body is None:
+                return await receive()
+            message = {"type": "http.request", "body": body, "more_body": False}
+            body = None
+            return message
+
+        async def capture(message):
+            nonlocal status, headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = [[name.decode("latin-1"), value.decode("latin-1")] for name, value in message.get("headers", [])]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            await self.app(scope, replay_body, capture)
+        except BaseException:
+            await idempotency.release_key(key)
+            raise
+        response = idempotency.StoredResponse(fingerprint, status, headers, b"".join(chunks))
+        if status >= 500:
+            await idempotency.release_key(key)
+        else:
+            await idempotency.save_response(key, response)
+        return response
+
+
+async def read_body(receive, limit: int, headers=()) -> bytes | None:
+    """Тело запроса целиком; None — клиент отключился, не дослав его.
+
+    Тело длиннее limit байт не дочитывается: PayloadTooLargeError.
+    """
+    for name, value in headers:
+        if name == b"content-length" and value.isdigit() and int(value) > limit:
+            raise PayloadTooLargeError()
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise PayloadTooLargeError()
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
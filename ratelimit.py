@@ -0,0 +1,106 @@
+"""Ограничение частоты запросов по пользователю Telegram.
+
+Корзины токенов живут в памяти воркера: проверка не ходит ни в базу, ни в сеть.
+Лимиты задаются на маршрут в settings.RATE_LIMITS; с несколькими воркерами
+каждый считает свои корзины, и общий лимит соответственно выше.
+"""
+
+
+class TokenBuckets:
+    """Корзины токенов одного маршрута, разложенные по шардам.
+
+    Корзина, простоявшая столько, сколько нужно на полное пополнение, ничем не
+    отличается от новой, поэтому удаляется без потери состояния. Шарды
+    вычищаются по одному, так что пауза на очистку ограничена размером шарда,
+    а память — пользователями, активными за время пополнения корзины.
+    """
+
+    def __init__(self, rate: float, burst: float, shards: int):
+        if shards & (shards - 1):
+            raise ValueError("Число шардов должно быть степенью двойки")
+        self.rate = rate
+        self.burst = burst
+        self.refill = burst / rate
+        # ключ клиента -> [токены, момент последнего обновления]
+        self._shards: list[dict] = [{} for _ in range(shards)]
+        self._mask = shards - 1
+        self._next_sweep = 0.0
+        self._sweep_shard = 0
+        self.rejected = 0
+
+    def take(self, key, now: float) -> float:
+        """Забирает токен; 0 — запрос пропущен, иначе через сколько секунд появится токен"""
+        if now >= self._next_sweep:
+            self._sweep(now)
+        shard = self._shards[hash(key) & self._mask]
+        bucket = shard.get(key)
+        if bucket is None:
+            shard[key] = [self.burst - 1, now]
+            return 0.0
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.rejected += 1
+            return (1 - tokens) / self.rate
+        bucket[0] = tokens - 1
+        return 0.0
+
+    def _sweep(self, now: float):
+        # Каждый шард вычищается раз за время пополнения корзины
+        self._next_sweep = now + self.refill / len(self._shards)
+        index = self._sweep_shard
+        self._sweep_shard = (index + 1) & self._mask
+        refill = self.refill
+        # Новый словарь вместо удаления ключей: dict не отдаёт память после del
+        self._shards[index] = {key: bucket for key, bucket in self._shards[index].items() if now - bucket[1] < refill}
+
+    def __len__(self) -> int:
+        return sum(map(len, self._shards))
+
+
+class RateLimiter:
+    """Сопоставляет запрос с ограниченным маршрутом до роутинга FastAPI"""
+
+    def __init__(self):
+        # метод -> [(маршрут, корзины)]
+        self.rules: dict[str, list] = {}
+
+    def configure(self, routes, limits: dict[str, tuple[float, float]], shards: int):
+        """Строит правила из маршрутов приложения: ключ лимита — «МЕТОД /шаблон/пути»"""
+        by_name = {f"{method} {route.path}": route for route in routes for method in getattr(route, "methods", None) or ()}
+        rules = {}
+        for name, (rate, burst) in limits.items():
+            route = by_name.get(name)
+            if route is None:
+                raise ValueError(f"RATE_LIMITS: нет маршрута {name}")
+            method = name.partition(" ")[0]
+            rules.setdefault(method, []).append((route, TokenBuckets(rate, burst, shards)))
+        self.rules = rules
+
+    def match(self, scope):
+        """Маршрут и его корзины, если запрос попадает под лимит"""
+        rules = self.rules.get(scope["method"])
+        if rules:
+            path = scope["path"]
+            for route, buckets in rules:
+                if route.path_regex.match(path):
+                    return route, buckets
+        return None
+
+    def stats(self) -> dict:
+        return {
+            f"{method} {route.path}": {
+                "rate": buckets.rate,
+                "burst": buckets.burst,
+                "buckets": len(buckets),
+                "rejected": buckets.rejected,
+            }
+            for method, rules in self.rules.items()
+            for route, buckets in rules
+        }
+
+
+limiter = RateLimiter()
@@ -0,0 +1,102 @@
+"""Кэш пар: LRU, время жизни, эпоха и вытеснение после коммита.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+from unittest import mock
+
+from database.cache import LRUCache, couple_cache, invalidate_couples
+from database.crud import add_user_to_db, add_wishes_to_db, create_couple
+from database.db import engine, session
+from database.migrate import ensure_schema
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1, cache.epoch)
+        cache.set("b", 2, cache.epoch)
+        cache.get("a")
+        cache.set("c", 3, cache.epoch)
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expired_entry_is_a_miss(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with mock.patch("database.cache.time.monotonic", return_value=100.0):
+            cache.set("a", 1, cache.epoch)
+        with mock.patch("database.cache.time.monotonic", return_value=161.0):
+            self.assertIsNone(cache.get("a"))
+
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_value_read_before_invalidation_is_not_cached(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        epoch = cache.epoch
+        # Запись в другую пару, пока читали эту: значение могло устареть
+        cache.invalidate("b")
+        cache.set("a", 1, epoch)
+
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1, cache.epoch)
+        self.assertEqual(cache.get("a"), 1)
+
+    def test_clear(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1, cache.epoch)
+        epoch = cache.epoch
+        cache.clear()
+
+        self.assertIsNone(cache.get("a"))
+        self.assertGreater(cache.epoch, epoch)
+
+
+class CommitInvalidationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        for user_id in (1, 2):
+            await add_user_to_db(user_id, f"user{user_id}")
+        self.couple_id = (await create_couple(1, 2)).id
+        couple_cache.clear()
+        couple_cache.set(self.couple_id, ("etag", b"{}"), couple_cache.epoch)
+
+    async def asyncTearDown(self):
+        couple_cache.clear()
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def test_write_evicts_after_commit(self):
+        async with session() as sess:
+            invalidate_couples(sess, self.couple_id)
+            # До коммита другие запросы ещё видят старые данные, и кэш им соответствует
+            self.assertIsNotNone(couple_cache.get(self.couple_id))
+            await sess.commit()
+
+        self.assertIsNone(couple_cache.get(self.couple_id))
+
+    async def test_rollback_keeps_entry(self):
+        epoch = couple_cache.epoch
+        async with session() as sess:
+            invalidate_couples(sess, self.couple_id)
+            await sess.rollback()
+
+        self.assertIsNotNone(couple_cache.get(self.couple_id))
+        self.assertEqual(couple_cache.epoch, epoch)
+
+    async def test_crud_write_evicts(self):
+        await add_wishes_to_db(self.couple_id, [
+            {"name": "wish", "price": 1, "article": 1, "url": "https://example.com", "user_added_id": 1},
+        ])
+
+        self.assertIsNone(couple_cache.get(self.couple_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
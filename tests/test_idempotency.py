@@ -0,0 +1,123 @@
+"""Idempotency-Key на встроенной SQLite в памяти: приложение вызывается напрямую через ASGI.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+import uuid
+from unittest import mock
+
+import orjson
+from sqlalchemy import func, select
+
+from database.config import settings
+from database.db import engine, session
+from database.migrate import ensure_schema
+from database.models import User
+from main import app
+
+
+async def call(method: str, path: str, body: bytes = b"", headers: dict[str, str] | None = None, chunk_size: int | None = None):
+    """Запрос к приложению: (код, заголовки, тело). С chunk_size тело идёт частями без Content-Length"""
+    path, _, query = path.partition("?")
+    raw_headers = [(b"host", b"test")]
+    if chunk_size is None:
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+        chunks = [body]
+    else:
+        chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+    raw_headers += [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "scheme": "http",
+        "method": method, "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+        "root_path": "", "headers": raw_headers, "client": ("127.0.0.1", 1), "server": ("test", 80),
+    }
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    response = {"headers": {}, "body": b""}
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode(): value.decode() for name, value in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+def user(user_id: int) -> bytes:
+    return orjson.dumps({"id": user_id, "username": f"user{user_id}"})
+
+
+class IdempotencyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        # Сохранённые ответы живут и в памяти процесса: у каждого теста свой ключ
+        self.key = {"Idempotency-Key": str(uuid.uuid4()), "Content-Type": "application/json"}
+        limit = mock.patch.object(settings, "IDEMPOTENCY_MAX_BODY_SIZE", 1024)
+        limit.start()
+        self.addCleanup(limit.stop)
+
+    async def asyncTearDown(self):
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def users(self) -> int:
+        async with session() as sess:
+            return await sess.scalar(select(func.count()).select_from(User))
+
+    async def test_replay(self):
+        first = await call("POST", "/users/", user(1), self.key)
+        second = await call("POST", "/users/", user(1), self.key)
+
+        self.assertEqual(first[0], 200)
+        self.assertEqual(second[0], 200)
+        self.assertEqual(second[2], first[2])
+        self.assertEqual(second[1].get("idempotent-replayed"), "true")
+        self.assertNotIn("idempotent-replayed", first[1])
+        self.assertEqual(await self.users(), 1)
+
+    async def test_reused_key_with_other_body(self):
+        await call("POST", "/users/", user(1), self.key)
+
+        status, _, _ = await call("POST", "/users/", user(2), self.key)
+
+        self.assertEqual(status, 422)
+        self.assertEqual(await self.users(), 1)
+
+    async def test_body_over_limit(self):
+        body = orjson.dumps([{"id": user_id, "username": f"user{user_id}"} for user_id in range(100)])
+
+        declared = await call("POST", "/users/bulk", body, self.key)
+        streamed = await call("POST", "/users/bulk", body, self.key, chunk_size=256)
+
+        self.assertEqual(declared[0], 413)
+        self.assertEqual(streamed[0], 413)
+        self.assertEqual(await self.users(), 0)
+
+    async def test_unbuffered_route_refuses_key(self):
+        status, _, _ = await call("POST", "/internal/import", b"{}\n", self.key)
+
+        self.assertEqual(status, 400)
+
+    async def test_without_key(self):
+        status, _, _ = await call("POST", "/users/", user(1), {"Content-Type": "application/json"})
+        replay, _, _ = await call("POST", "/users/", user(1), {"Content-Type": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(replay, 409)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""Доступ к служебным маршрутам /internal/*.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+from unittest import mock
+
+from fastapi.routing import APIRoute
+
+from database.config import settings
+from database.db import engine
+from database.migrate import ensure_schema
+from main import app
+from tests.test_idempotency import call
+
+
+class InternalRoutesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        token = mock.patch.object(settings, "INTERNAL_TOKEN", "secret")
+        token.start()
+        self.addCleanup(token.stop)
+
+    async def asyncTearDown(self):
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def test_every_internal_route_requires_token(self):
+        for route in app.routes:
+            if isinstance(route, APIRoute) and route.path.startswith("/internal/"):
+                for method in route.methods:
+                    status, _, _ = await call(method, route.path.replace("{", "").replace("}", ""))
+                    self.assertEqual(status, 403, f"{method} {route.path}")
+
+    async def test_token(self):
+        wrong, _, _ = await call("GET", "/internal/ratelimit", headers={"X-Internal-Token": "guess"})
+        right, _, _ = await call("GET", "/internal/ratelimit", headers={"X-Internal-Token": "secret"})
+
+        self.assertEqual((wrong, right), (403, 200))
+
+    async def test_disabled_without_setting(self):
+        with mock.patch.object(settings, "INTERNAL_TOKEN", None):
+            status, _, _ = await call("GET", "/internal/ratelimit", headers={"X-Internal-Token": ""})
+
+        self.assertEqual(status, 403)
+
+    async def test_import_refused_on_sqlite_in_memory(self):
+        status, _, _ = await call("POST", "/internal/import", b"{}\n", headers={"X-Internal-Token": "secret"})
+
+        self.assertEqual(status, 501)
+
+
+if __name__ == "__main__":
+    unittest.main()
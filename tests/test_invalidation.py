@@ -0,0 +1,59 @@
+"""Рассылка инвалидаций кэша пар между воркерами: ключи в NOTIFY и их применение.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+
+from database.cache import ALL, couple_cache
+from database.invalidation import MAX_PAYLOAD, apply_payload, encode_keys
+
+
+class PayloadTest(unittest.TestCase):
+    def setUp(self):
+        couple_cache.clear()
+        self.addCleanup(couple_cache.clear)
+
+    def test_round_trip(self):
+        for couple_id in (1, 2, 3):
+            couple_cache.set(couple_id, ("etag", b"{}"), couple_cache.epoch)
+        epoch = couple_cache.epoch
+
+        payload = encode_keys({3, 1})
+        apply_payload(payload)
+
+        self.assertEqual(payload, "couple:1,couple:3")
+        self.assertEqual([couple_cache.get(couple_id) is not None for couple_id in (1, 2, 3)], [False, True, False])
+        # Чтение, начатое до уведомления, не положит в кэш устаревшую пару
+        self.assertGreater(couple_cache.epoch, epoch)
+
+    def test_all_couples(self):
+        couple_cache.set(1, ("etag", b"{}"), couple_cache.epoch)
+
+        self.assertEqual(encode_keys({1, ALL}), "*")
+        apply_payload("*")
+
+        self.assertIsNone(couple_cache.get(1))
+
+    def test_long_payload_falls_back_to_all(self):
+        payload = encode_keys(set(range(MAX_PAYLOAD)))
+
+        self.assertEqual(payload, "*")
+
+    def test_unknown_keys_are_ignored(self):
+        couple_cache.set(1, ("etag", b"{}"), couple_cache.epoch)
+        epoch = couple_cache.epoch
+
+        apply_payload("user:1,couple:x")
+
+        self.assertIsNotNone(couple_cache.get(1))
+        self.assertGreater(couple_cache.epoch, epoch)
+
+
+if __name__ == "__main__":
+    unittest.main()
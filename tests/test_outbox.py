@@ -0,0 +1,95 @@
+"""Рассылка outbox на встроенной SQLite в памяти.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+
+from sqlalchemy import select
+
+from database.config import settings
+from database.db import engine, session
+from database.migrate import ensure_schema
+from database.models import OutboxEvent, utcnow
+from database.outbox import OutboxDispatcher
+
+
+class DispatchTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        now = utcnow()
+        async with session() as sess:
+            sess.add_all([
+                OutboxEvent(recipient_id=recipient_id, event="partner_left", payload={"user_id": 9}, created_at=now, available_at=now)
+                for recipient_id in (1, 1, 2)
+            ])
+            await sess.commit()
+        self.sent = []
+        self.failing = set()
+
+    async def asyncTearDown(self):
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def sender(self, recipient_id: int, events: list[dict]):
+        if recipient_id in self.failing:
+            raise RuntimeError("Telegram недоступен")
+        self.sent.append((recipient_id, [event["event"] for event in events]))
+
+    async def rows(self):
+        async with session() as sess:
+            return (await sess.scalars(select(OutboxEvent).order_by(OutboxEvent.id))).all()
+
+    async def test_delivered_rows_are_deleted(self):
+        claimed = await OutboxDispatcher(self.sender, 10, 1).dispatch()
+
+        self.assertEqual(claimed, 3)
+        self.assertEqual(sorted(self.sent), [(1, ["partner_left", "partner_left"]), (2, ["partner_left"])])
+        self.assertEqual(await self.rows(), [])
+
+    async def test_failed_rows_are_retried_later(self):
+        self.failing.add(2)
+        dispatcher = OutboxDispatcher(self.sender, 10, 1)
+
+        with self.assertLogs("database.outbox", "ERROR"):
+            await dispatcher.dispatch()
+
+        [row] = await self.rows()
+        self.assertEqual((row.recipient_id, row.attempts), (2, 1))
+        self.assertGreater(row.available_at, utcnow())
+        self.assertEqual(await dispatcher.dispatch(), 0)
+
+    async def test_no_connection_is_held_while_sending(self):
+        concurrent = []
+
+        async def sender(recipient_id, events):
+            # Пул SQLite в памяти — одно соединение: если бы пачка держала его, здесь было бы ожидание
+            concurrent.append(await OutboxDispatcher(self.sender, 10, 1).dispatch())
+
+        await OutboxDispatcher(sender, 10, 1).dispatch()
+
+        # Взятые строки в аренде и второму рассыльщику не достаются
+        self.assertEqual(concurrent, [0, 0])
+
+    async def test_dropped_after_max_attempts(self):
+        self.failing.update((1, 2))
+        async with session() as sess:
+            for row in await sess.scalars(select(OutboxEvent)):
+                row.attempts = settings.OUTBOX_MAX_ATTEMPTS - 1
+            await sess.commit()
+        dispatcher = OutboxDispatcher(self.sender, 10, 1)
+
+        with self.assertLogs("database.outbox", "ERROR"):
+            await dispatcher.dispatch()
+
+        self.assertEqual(await self.rows(), [])
+        self.assertEqual(dispatcher.stats()["dropped"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
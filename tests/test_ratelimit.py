@@ -0,0 +1,113 @@
+"""Корзины токенов и доверие к X-Telegram-User-Id.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+from ipaddress import ip_network
+from unittest import mock
+
+from fastapi import FastAPI
+
+import middleware
+from ratelimit import RateLimiter, TokenBuckets
+
+
+class TokenBucketsTest(unittest.TestCase):
+    def test_burst_then_wait(self):
+        buckets = TokenBuckets(rate=2.0, burst=3, shards=4)
+
+        self.assertEqual([buckets.take("a", 10.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(buckets.take("a", 10.0), 0.5)
+        # Через четверть секунды накопилось полтокена: до целого ещё столько же
+        self.assertAlmostEqual(buckets.take("a", 10.25), 0.25)
+        self.assertEqual(buckets.take("a", 10.5), 0.0)
+        self.assertEqual(buckets.rejected, 2)
+
+    def test_keys_are_independent(self):
+        buckets = TokenBuckets(rate=1.0, burst=1, shards=4)
+
+        self.assertEqual(buckets.take("a", 0.0), 0.0)
+        self.assertGreater(buckets.take("a", 0.0), 0)
+        self.assertEqual(buckets.take("b", 0.0), 0.0)
+
+    def test_refill_is_capped_by_burst(self):
+        buckets = TokenBuckets(rate=1.0, burst=2, shards=4)
+        buckets.take("a", 0.0)
+
+        self.assertEqual([buckets.take("a", 100.0) for _ in range(2)], [0.0, 0.0])
+        self.assertGreater(buckets.take("a", 100.0), 0)
+
+    def test_sweep_drops_refilled_buckets(self):
+        buckets = TokenBuckets(rate=1.0, burst=2, shards=2)
+        for key in range(100):
+            buckets.take(key, 0.0)
+
+        # Каждый шард вычищается раз за время пополнения (2 с); новая корзина остаётся
+        for now in (3.0, 4.0, 5.0):
+            buckets.take("fresh", now)
+
+        self.assertEqual(len(buckets), 1)
+
+    def test_shards_must_be_power_of_two(self):
+        with self.assertRaises(ValueError):
+            TokenBuckets(rate=1.0, burst=1, shards=3)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.post("/users/")(lambda: None)
+        app.put("/couples/{couple_id}")(lambda couple_id: None)
+        self.routes = app.routes
+
+    def test_match_by_method_and_template(self):
+        limiter = RateLimiter()
+        limiter.configure(self.routes, {"PUT /couples/{couple_id}": (1.0, 1)}, 4)
+
+        self.assertIsNotNone(limiter.match({"method": "PUT", "path": "/couples/7"}))
+        self.assertIsNone(limiter.match({"method": "GET", "path": "/couples/7"}))
+        self.assertIsNone(limiter.match({"method": "POST", "path": "/users/"}))
+
+    def test_unknown_route(self):
+        with self.assertRaises(ValueError):
+            RateLimiter().configure(self.routes, {"POST /nope": (1.0, 1)}, 4)
+
+
+class TelegramUserKeyTest(unittest.TestCase):
+    def setUp(self):
+        networks = mock.patch.object(middleware, "TRUSTED_NETWORKS", (ip_network("10.0.0.0/24"),))
+        networks.start()
+        self.addCleanup(networks.stop)
+        middleware.is_trusted_proxy.cache_clear()
+        self.addCleanup(middleware.is_trusted_proxy.cache_clear)
+
+    @staticmethod
+    def scope(address: str, user_id: str | None = None) -> dict:
+        headers = [] if user_id is None else [(b"x-telegram-user-id", user_id.encode())]
+        return {"client": (address, 1), "headers": headers}
+
+    def test_header_from_trusted_proxy(self):
+        scope = self.scope("10.0.0.5", "42")
+
+        self.assertEqual(middleware.telegram_user_key(scope), "tg:42")
+        self.assertEqual(middleware.request_client_key(scope), "tg:42")
+
+    def test_header_from_untrusted_address_is_ignored(self):
+        scope = self.scope("192.0.2.1", "42")
+
+        # Без доверенного заголовка лимиты и прилипание к основной базе не действуют
+        self.assertIsNone(middleware.telegram_user_key(scope))
+        self.assertEqual(middleware.request_client_key(scope), "192.0.2.1")
+
+    def test_trusted_proxy_without_header(self):
+        self.assertIsNone(middleware.telegram_user_key(self.scope("10.0.0.5")))
+
+
+if __name__ == "__main__":
+    unittest.main()
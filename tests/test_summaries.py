@@ -0,0 +1,101 @@
+"""Сводки желаний против пересчёта GROUP BY на встроенной SQLite в памяти.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+
+from sqlalchemy import func, select
+
+from database.crud import (
+    add_user_to_db,
+    add_wishes_to_db,
+    create_couple,
+    delete_wish_from_db,
+    update_user_in_db,
+    update_wish_in_db,
+)
+from database.db import engine, session
+from database.migrate import ensure_schema
+from database.models import Wish, WishSummary
+
+
+def wish(user_id: int, price: float) -> dict:
+    return {"name": f"wish {price}", "price": price, "article": 1, "url": "https://example.com", "user_added_id": user_id}
+
+
+class WishSummaryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        for user_id in (1, 2, 3):
+            await add_user_to_db(user_id, f"user{user_id}")
+        self.couple_id = (await create_couple(1, 2)).id
+
+    async def asyncTearDown(self):
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def assertSummariesMatch(self):
+        async with session() as sess:
+            summaries = (await sess.execute(
+                select(WishSummary.couple_id, WishSummary.user_added_id, WishSummary.count,
+                       WishSummary.total, WishSummary.min_price, WishSummary.max_price)
+                .order_by(WishSummary.couple_id, WishSummary.user_added_id)
+            )).all()
+            recomputed = (await sess.execute(
+                select(Wish.couple_id, Wish.user_added_id, func.count(),
+                       func.sum(Wish.price), func.min(Wish.price), func.max(Wish.price))
+                .group_by(Wish.couple_id, Wish.user_added_id)
+                .order_by(Wish.couple_id, Wish.user_added_id)
+            )).all()
+        self.assertEqual(summaries, recomputed)
+        return summaries
+
+    async def test_add(self):
+        await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(1, 7), wish(2, 9)])
+        await add_wishes_to_db(self.couple_id, [wish(1, 3)])
+
+        summaries = await self.assertSummariesMatch()
+        self.assertEqual(summaries[0][2:], (3, 15, 3, 7))
+
+    async def test_reprice(self):
+        wishes = await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(1, 7), wish(1, 9)])
+
+        # Крайние цены: самая дорогая дешевеет, самая дешёвая дорожает
+        await update_wish_in_db(wishes[2].id, price=1)
+        await update_wish_in_db(wishes[1].id, price=6)
+        await update_wish_in_db(wishes[0].id, price=8)
+
+        summaries = await self.assertSummariesMatch()
+        self.assertEqual(summaries[0][2:], (3, 15, 1, 8))
+
+    async def test_move(self):
+        await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(2, 9)])
+        other_couple_id = (await create_couple(3)).id
+
+        # Желания остаются в прежней паре, где есть партнёр; в новой пользователь добавляет свои
+        await update_user_in_db(1, "user1", other_couple_id)
+        await add_wishes_to_db(other_couple_id, [wish(1, 4), wish(3, 2)])
+
+        summaries = await self.assertSummariesMatch()
+        self.assertEqual([row[:2] for row in summaries], [(self.couple_id, 1), (self.couple_id, 2), (other_couple_id, 1), (other_couple_id, 3)])
+
+    async def test_delete(self):
+        wishes = await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(1, 7), wish(2, 9)])
+
+        await delete_wish_from_db(wishes[1].id)
+        await self.assertSummariesMatch()
+        await delete_wish_from_db(wishes[0].id)
+
+        summaries = await self.assertSummariesMatch()
+        # Строка автора без желаний удаляется
+        self.assertEqual([row[1] for row in summaries], [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
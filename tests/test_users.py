@@ -0,0 +1,81 @@
+"""Удаление пользователя на встроенной SQLite в памяти.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import unittest
+
+from sqlalchemy import select
+
+from database.crud import add_user_to_db, add_wishes_to_db, create_couple, delete_user_from_db
+from database.db import engine, session
+from database.migrate import ensure_schema
+from database.models import Couple, OutboxEvent, User, Wish, WishSummary
+from exceptions import UserHasWishesError
+
+
+def wish(user_id: int, price: float) -> dict:
+    return {"name": f"wish {price}", "price": price, "article": 1, "url": "https://example.com", "user_added_id": user_id}
+
+
+class DeleteUserTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await ensure_schema()
+        for user_id in (1, 2):
+            await add_user_to_db(user_id, f"user{user_id}")
+        self.couple_id = (await create_couple(1, 2)).id
+
+    async def asyncTearDown(self):
+        # База в памяти живёт, пока открыто единственное соединение пула
+        await engine.dispose()
+
+    async def test_delete_author_with_partner_in_couple_is_refused(self):
+        await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(1, 7), wish(2, 9)])
+
+        with self.assertRaises(UserHasWishesError):
+            await delete_user_from_db(1)
+
+        async with session() as sess:
+            self.assertIsNotNone(await sess.get(User, 1))
+            self.assertEqual(len((await sess.scalars(select(Wish.id))).all()), 3)
+
+    async def test_delete_author_with_purge_wishes(self):
+        await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(1, 7), wish(2, 9)])
+
+        await delete_user_from_db(1, purge_wishes=True)
+
+        async with session() as sess:
+            wishes = (await sess.execute(select(Wish.couple_id, Wish.user_added_id))).all()
+            summaries = (await sess.execute(select(WishSummary.user_added_id, WishSummary.count))).all()
+            events = (await sess.execute(select(OutboxEvent.recipient_id, OutboxEvent.event))).all()
+        self.assertEqual(wishes, [(self.couple_id, 2)])
+        self.assertEqual(summaries, [(2, 1)])
+        self.assertIn((2, "partner_left"), events)
+
+    async def test_delete_user_without_wishes(self):
+        await add_wishes_to_db(self.couple_id, [wish(2, 9)])
+
+        await delete_user_from_db(1)
+
+        async with session() as sess:
+            self.assertIsNone(await sess.get(User, 1))
+            self.assertEqual((await sess.execute(select(Wish.user_added_id))).scalars().all(), [2])
+
+    async def test_delete_last_author_drops_couple(self):
+        await add_wishes_to_db(self.couple_id, [wish(1, 5), wish(2, 9)])
+
+        await delete_user_from_db(2, purge_wishes=True)
+        await delete_user_from_db(1)
+
+        async with session() as sess:
+            self.assertIsNone(await sess.get(Couple, self.couple_id))
+            self.assertEqual((await sess.scalars(select(Wish.id))).all(), [])
+            self.assertEqual((await sess.scalars(select(WishSummary.couple_id))).all(), [])
+
+if __name__ == "__main__":
+    unittest.main()
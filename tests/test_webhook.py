@@ -0,0 +1,108 @@
+"""Очередь обновлений Telegram: порядок внутри чата, параллельность между чатами.
+
+    python -m unittest discover tests
+"""
+import os
+
+# До импорта database: настройки читаются при импорте
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["DB_SQLITE_PATH"] = ":memory:"
+
+import asyncio
+import random
+import unittest
+
+from webhook import UpdateQueue, update_key
+
+
+def message(update_id: int, chat_id: int) -> dict:
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": "hi"}}
+
+
+class UpdateKeyTest(unittest.TestCase):
+    def test_chat_of_callback_query(self):
+        update = {"update_id": 1, "callback_query": {"from": {"id": 5}, "message": {"chat": {"id": 7}}}}
+
+        self.assertEqual(update_key(update), 7)
+
+    def test_sender_without_chat(self):
+        self.assertEqual(update_key({"update_id": 1, "inline_query": {"from": {"id": 5}}}), 5)
+
+    def test_update_without_chat_or_sender(self):
+        self.assertEqual(update_key({"update_id": 3, "poll": {"id": "p"}}), ("update", 3))
+
+
+class UpdateQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_order_within_chat(self):
+        handled: dict[int, list[int]] = {}
+        running: set[int] = set()
+        overlapped = []
+
+        async def handler(update):
+            chat_id = update["message"]["chat"]["id"]
+            if chat_id in running:
+                overlapped.append(update["update_id"])
+            running.add(chat_id)
+            # Случайная задержка перемешала бы порядок, если бы чат брали два воркера
+            await asyncio.sleep(random.random() / 1000)
+            handled.setdefault(chat_id, []).append(update["update_id"])
+            running.discard(chat_id)
+
+        queue = UpdateQueue(handler, capacity=1000, workers=8)
+        queue.start()
+        for update_id in range(300):
+            self.assertTrue(queue.submit(message(update_id, update_id % 5)))
+        await queue.stop(timeout=10)
+
+        self.assertEqual(overlapped, [])
+        for chat_id, update_ids in handled.items():
+            self.assertEqual(update_ids, sorted(update_ids))
+        self.assertEqual(sum(map(len, handled.values())), 300)
+        self.assertEqual(queue.stats()["processed"], 300)
+
+    async def test_chats_run_in_parallel(self):
+        started = asyncio.Event()
+        release = asyncio.Event()
+        handled = []
+
+        async def handler(update):
+            if update["message"]["chat"]["id"] == 1:
+                started.set()
+                await release.wait()
+            handled.append(update["update_id"])
+
+        queue = UpdateQueue(handler, capacity=10, workers=2)
+        queue.start()
+        queue.submit(message(1, 1))
+        queue.submit(message(2, 1))
+        queue.submit(message(3, 2))
+        await started.wait()
+        # Чат 2 обрабатывается, пока чат 1 ждёт; второе обновление чата 1 — нет
+        await asyncio.sleep(0.01)
+        self.assertEqual(handled, [3])
+        release.set()
+        await queue.stop(timeout=1)
+
+        self.assertEqual(handled, [3, 1, 2])
+
+    async def test_capacity_and_failures(self):
+        async def handler(update):
+            if update["update_id"] == 1:
+                raise RuntimeError("boom")
+
+        queue = UpdateQueue(handler, capacity=2, workers=1)
+        queue.start()
+
+        self.assertTrue(queue.submit(message(1, 1)))
+        self.assertTrue(queue.submit(message(2, 1)))
+        self.assertFalse(queue.submit(message(3, 1)))
+        with self.assertLogs("webhook", "ERROR"):
+            await queue.stop(timeout=1)
+        self.assertFalse(queue.submit(message(4, 1)))
+
+        stats = queue.stats()
+        self.assertEqual((stats["processed"], stats["failed"], stats["rejected"]), (1, 1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Приём обновлений Telegram через webhook.
+
+Маршрут отвечает Telegram сразу, а обновление кладётся в ограниченную очередь,
+которую разбирает пул воркеров asyncio. Обновления одного чата обрабатываются
+строго по порядку, разных чатов — параллельно.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from database.config import settings
+from database.crud import add_user_to_db
+from exceptions import UserAlreadyExistsError
+from metrics import TELEGRAM_DURATION, TELEGRAM_WAIT
+
+logger = logging.getLogger(__name__)
+
+UpdateHandler = Callable[[dict], Awaitable[None]]
+
+
+def update_kind(update: dict) -> str:
+    """Вид обновления: message, callback_query и т. д. — единственное поле, кроме update_id"""
+    return next((kind for kind in update if kind != "update_id"), "unknown")
+
+def update_key(update: dict):
+    """Ключ порядка: id чата, иначе id отправителя; обновлениям без них порядок не нужен"""
+    payload = update.get(update_kind(update))
+    if isinstance(payload, dict):
+        # У callback_query чат лежит в сообщении с кнопкой
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        sender = payload.get("from") or payload.get("user")
+        if sender:
+            return sender["id"]
+    return ("update", update.get("update_id"))
+
+
+class UpdateQueue:
+    """Очередь обновлений с порядком внутри чата.
+
+    У каждого чата своя очередь, а в общую очередь попадает только id чата: пока воркер
+    обрабатывает обновление, второй воркер этот чат не возьмёт. После каждого обновления
+    чат встаёт в конец общей очереди, чтобы один активный чат не занимал воркер целиком.
+    """
+
+    def __init__(self, handler: UpdateHandler, capacity: int, workers: int):
+        self.handler = handler
+        self.capacity = capacity
+        self.workers = workers
+        # ключ чата -> deque[(момент постановки, обновление)]
+        self._pending: dict = {}
+        self._ready: asyncio.Queue | None = None
+        self._drained: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        # Обновления в очереди и в обработке
+        self._size = 0
+        self._busy = 0
+        self.accepting = False
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, update: dict) -> bool:
+        """Ставит обновление в очередь; False — очередь полна или приложение останавливается"""
+        if not self.accepting or self._size >= self.capacity:
+            self.rejected += 1
+            return False
+        key = update_key(update)
+        item = (time.monotonic(), update)
+        chat = self._pending.get(key)
+        if chat is None:
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            chat.append(item)
+        self._size += 1
+        self.accepted += 1
+        self._drained.clear()
+        return True
+
+    def start(self):
+        # Очередь и событие привязываются к циклу событий, поэтому создаются в нём
+        self._ready = asyncio.Queue()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.accepting = True
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float):
+        """Перестаёт принимать обновления и ждёт, пока воркеры обработают уже принятые"""
+        self.accepting = False
+        if self._drained is not None:
+            try:
+                async with asyncio.timeout(timeout):
+                    await self._drained.wait()
+            except TimeoutError:
+                logger.warning("Telegram queue not drained in %.1fs, dropping %d updates", timeout, self._size)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            chat = self._pending[key]
+            enqueued_at, update = chat.popleft()
+            started = time.monotonic()
+            TELEGRAM_WAIT.observe(started - enqueued_at)
+            kind = update_kind(update)
+            self._busy += 1
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Telegram update %s (%s) failed", update.get("update_id"), kind)
+            finally:
+                TELEGRAM_DURATION.labels(kind).observe(time.monotonic() - started)
+                self._busy -= 1
+                self._size -= 1
+                if chat:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                if not self._size:
+                    self._drained.set()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._size,
+            "capacity": self.capacity,
+            "chats": len(self._pending),
+            "busy": self._busy,
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+# ----- Обработчики -----
+
+# Команда без слэша -> обработчик сообщения
+COMMANDS: dict[str, Callable[[dict], Awaitable[None]]] = {}
+
+
+def command(name: str):
+    """Регистрирует обработчик команды бота, например @command("start") для /start"""
+    def register(func):
+        COMMANDS[name] = func
+        return func
+    return register
+
+def message_command(message: dict) -> str | None:
+    """Команда из текста сообщения: /start@my_bot payload -> start"""
+    text = message.get("text") or ""
+    if not text.startswith("/"):
+        return None
+    return text[1:].split(maxsplit=1)[0].partition("@")[0].lower() or None
+
+async def handle_update(update: dict):
+    message = update.get("message")
+    if not message:
+        return
+    handler = COMMANDS.get(message_command(message))
+    if handler is not None:
+        await handler(message)
+
+@command("start")
+async def start(message: dict):
+    sender = message.get("from")
+    if not sender or sender.get("is_bot"):
+        return
+    username = sender.get("username") or sender.get("first_name") or str(sender["id"])
+    try:
+        await add_user_to_db(sender["id"], username)
+    except UserAlreadyExistsError:
+        pass
+
+
+updates = UpdateQueue(handle_update, settings.TELEGRAM_QUEUE_SIZE, settings.TELEGRAM_WORKERS)